@@ -0,0 +1,47 @@
+"""
+Parses a large generated program and reports how long parsing takes and how much memory the resulting AST holds on
+to, per node.
+
+    python -m benchmarks.ast_nodes [--functions N] [--repeat N]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from benchmarks.expressions import program
+from spring.parser import parse
+from spring.scanner import scan
+from spring.spring_ast import count_nodes
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--functions", type=int, default=2000)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    tokens = scan(program(args.functions))
+
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        parse(tokens)
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = parse(tokens)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    nodes = count_nodes(tree)
+
+    print(f"{len(tokens)} tokens, {nodes} nodes")
+    print(f"parse: {best * 1000:.1f} ms")
+    print(f"AST: {size / 2 ** 20:.1f} MiB, {size / nodes:.0f} bytes per node")
+
+
+if __name__ == "__main__":
+    main()
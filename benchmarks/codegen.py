@@ -0,0 +1,54 @@
+"""
+Generates LLVM IR for programs of more and more functions and reports the time per function, which should stay about
+the same as the program grows. As with timeit, the garbage collector is off while timing, since its passes over
+everything else alive would otherwise hide how codegen itself scales.
+
+    python -m benchmarks.codegen [--functions N [N ...]] [--repeat N]
+"""
+import argparse
+import gc
+import pathlib
+import tempfile
+import time
+
+from spkt import ast_to_spkt
+from spkt.spkt_llvm import SpktToLLVM
+from spring import parse_text
+
+
+def program(functions: int) -> str:
+    lines = []
+    for n in range(functions):
+        lines.append(f"def f{n}() -> int {{")
+        lines.append(f"    return {n};")
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--functions", type=int, nargs="+", default=[1000, 2000, 4000, 8000])
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for functions in args.functions:
+            path = pathlib.Path(temp_dir) / f"f{functions}.spng"
+            path.write_text(program(functions))
+            modules = ast_to_spkt(parse_text(str(path), path.read_text()), path)
+
+            best = float("inf")
+            for _ in range(args.repeat):
+                gc.collect()
+                gc.disable()
+                try:
+                    start = time.perf_counter()
+                    SpktToLLVM().llvm_per_module(modules)
+                    best = min(best, time.perf_counter() - start)
+                finally:
+                    gc.enable()
+            print(f"{functions:>6} functions: {best * 1000:8.1f} ms, {best / functions * 1e6:.1f} us per function")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Parses a program made almost entirely of nested arithmetic, comparison, cast and call expressions and reports how
+many tokens per second the parser gets through.
+
+    python -m benchmarks.expressions [--functions N] [--repeat N]
+"""
+import argparse
+import random
+import time
+
+from spring.parser import parse
+from spring.scanner import scan
+
+OPERATORS = ["+", "-", "*", "/", "//", "%", "==", "!=", "<", ">", "<=", ">="]
+
+
+def expression(rand: random.Random, depth: int) -> str:
+    if depth == 0:
+        return rand.choice(["x", "y", "1", "2.5", "0xFF", "a.b", "f(x, 1)", "(y)"])
+    left = expression(rand, depth - 1)
+    right = expression(rand, depth - 1)
+    expr = f"{left} {rand.choice(OPERATORS)} {right}"
+    if rand.random() < 0.2:
+        expr = f"(({expr}) as int)"
+    return expr
+
+
+def program(functions: int, seed: int = 0) -> str:
+    rand = random.Random(seed)
+    lines = []
+    for n in range(functions):
+        lines.append(f"def f{n}(x: int, y: int) -> int {{")
+        for _ in range(4):
+            lines.append(f"    var v: int = {expression(rand, 4)};")
+        lines.append(f"    return {expression(rand, 3)};")
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--functions", type=int, default=200)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    tokens = scan(program(args.functions))
+
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        parse(tokens)
+        best = min(best, time.perf_counter() - start)
+
+    print(f"{len(tokens)} tokens in {best * 1000:.1f} ms ({len(tokens) / best:,.0f} tokens/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Generates large Spring programs for the benchmarks. The same seed and sizes always give the same program.
+
+    python -m benchmarks.generator [--functions N] [--classes N] [--overloads N] [--macro-uses N] [--depth N]
+                                   [--seed N] [--lowerable]
+
+prints one. `program` uses everything the parser knows: functions made of deeply nested expressions, statement and
+expression macros, generic and plain classes, and overloaded functions. `lowerable_program` sticks to what the back
+end can lower and generate code for so far, so that the whole pipeline can be timed on it.
+"""
+import argparse
+import random
+from typing import List
+
+from benchmarks.expressions import expression
+
+MACROS = """\
+#macro $(log $x : expr)$ => stmt : $( print($x); )$ #endmacro
+#macro $(log $x : expr , $y : expr)$ => stmt : $( print($x + $y); )$ #endmacro
+#macro $(repeat $body : stmt)$ => stmt : $( { $body $body } )$ #endmacro
+#macro $(twice $x : expr)$ => expr : $( $x * 2 )$ #endmacro
+#macro $(clamp $x : expr , $lo : expr)$ => expr : $( (($x < $lo) as int) * $lo )$ #endmacro
+"""
+
+
+def macro_use(rand: random.Random, depth: int) -> str:
+    use = rand.randrange(4)
+    if use == 0:
+        return f"log {expression(rand, depth)}"
+    if use == 1:
+        return f"log {expression(rand, depth)}, {expression(rand, depth)}"
+    if use == 2:
+        return f"repeat var r: int = twice {expression(rand, depth)};"
+    return f"var c: int = clamp {expression(rand, depth)}, {expression(rand, 1)};"
+
+
+def statements(rand: random.Random, depth: int, count: int, macro_uses: int) -> List[str]:
+    lines = []
+    for _ in range(count):
+        kind = rand.randrange(4)
+        if kind == 0:
+            lines.append(f"var v: int = {expression(rand, depth)};")
+        elif kind == 1:
+            lines.append(f"if ({expression(rand, depth - 1)}) {{ v = {expression(rand, depth - 1)}; }} "
+                         f"else {{ v = {expression(rand, depth - 1)}; }}")
+        elif kind == 2:
+            lines.append(f"while ({expression(rand, depth - 1)}) {{ f(v, {expression(rand, depth - 1)}); }}")
+        else:
+            lines.append(f"f({expression(rand, depth)}, {expression(rand, depth)});")
+    for _ in range(macro_uses):
+        lines.append(macro_use(rand, depth - 1))
+    lines.append(f"return {expression(rand, depth)};")
+    return ["    " + line for line in lines]
+
+
+def function(rand: random.Random, n: int, depth: int, macro_uses: int) -> List[str]:
+    return [f"def f{n}(x: int, y: int) -> int {{", *statements(rand, depth, 3, macro_uses), "}"]
+
+
+def overloaded(rand: random.Random, n: int, depth: int) -> List[str]:
+    lines = [f"def g{n} {{"]
+    for typ in ["int", "float", "str"][:rand.randrange(2, 4)]:
+        lines.append(f"    (x: {typ}, y: int) -> {typ} {{")
+        lines.extend("    " + line for line in statements(rand, depth - 1, 1, 0))
+        lines.append("    }")
+    lines.append("}")
+    return lines
+
+
+def cls(rand: random.Random, n: int, depth: int) -> List[str]:
+    generic = "<T>" if rand.random() < 0.3 else ""
+    base = f"(C{rand.randrange(n)})" if n and rand.random() < 0.5 else ""
+    lines = [f"class C{n}{generic}{base} {{"]
+    for a in range(rand.randrange(1, 4)):
+        lines.append(f"    attr a{a}: int;")
+    lines.append("    new(x: int) {")
+    lines.append(f"        var a: int = {expression(rand, depth - 2)};")
+    lines.append("    }")
+    for m in range(rand.randrange(1, 4)):
+        lines.append(f"    method m{m}(x: int, y: int) -> int {{")
+        lines.extend("    " + line for line in statements(rand, depth - 1, 1, 0))
+        lines.append("    }")
+    lines.append("}")
+    return lines
+
+
+def program(functions: int = 1000, classes: int = 100, overloads: int = 100, macro_uses: int = 2, depth: int = 4,
+            seed: int = 0) -> str:
+    """`macro_uses` macros are used in each function"""
+    rand = random.Random(seed)
+    parts = [(function, n) for n in range(functions)]
+    parts += [(cls, n) for n in range(classes)]
+    parts += [(overloaded, n) for n in range(overloads)]
+    # Classes stay in order, since each may derive from one before it
+    rand.shuffle(parts)
+    class_order = iter(range(classes))
+
+    lines = [MACROS]
+    for make, n in parts:
+        if make is function:
+            lines.extend(function(rand, n, depth, macro_uses))
+        elif make is cls:
+            lines.extend(cls(rand, next(class_order), depth))
+        else:
+            lines.extend(overloaded(rand, n, depth))
+    return "\n".join(lines) + "\n"
+
+
+def lowerable_program(functions: int = 1000, seed: int = 0) -> str:
+    rand = random.Random(seed)
+    lines = ['import "test.h"', ""]
+    for n in range(functions):
+        lines.append(f"def f{n}() -> int {{")
+        if rand.random() < 0.5:
+            lines.append("    test.test();")
+        lines.append(f"    return {rand.randrange(1000)};")
+        lines.append("}")
+    lines.extend(["def main() -> int {", "    test.test();", "    return 0;", "}"])
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--functions", type=int, default=1000)
+    arg_parser.add_argument("--classes", type=int, default=100)
+    arg_parser.add_argument("--overloads", type=int, default=100)
+    arg_parser.add_argument("--macro-uses", type=int, default=2)
+    arg_parser.add_argument("--depth", type=int, default=4)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--lowerable", action="store_true")
+    args = arg_parser.parse_args()
+
+    if args.lowerable:
+        print(lowerable_program(args.functions, args.seed), end="")
+    else:
+        print(program(args.functions, args.classes, args.overloads, args.macro_uses, args.depth, args.seed), end="")
+
+
+if __name__ == "__main__":
+    main()
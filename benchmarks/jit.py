@@ -0,0 +1,46 @@
+"""
+Runs a program both ways `spring run` can: compiled ahead of time by clang into an executable that is then started,
+and compiled in process by the JIT. Reports how long each takes, from lowered modules to `main` returning.
+
+    python -m benchmarks.jit [--repeat N] [program.spng]
+"""
+import argparse
+import pathlib
+import shutil
+import tempfile
+import time
+
+from spkt import ast_to_spkt, compile_spkt
+from spkt.spkt_llvm import run_jit
+from spring import parse_text
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("program", type=pathlib.Path, nargs="?", default=pathlib.Path("test.spng"))
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The executable is written next to the program, so build a copy of it
+        path = pathlib.Path(temp_dir) / args.program.name
+        shutil.copy(args.program, path)
+        program = parse_text(str(path), path.read_text())
+
+        aot = jit = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            compile_spkt(ast_to_spkt(program, path), and_run=True)
+            aot = min(aot, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            run_jit(ast_to_spkt(program, path))
+            jit = min(jit, time.perf_counter() - start)
+
+    print()
+    print(f"aot: {aot * 1000:.1f} ms")
+    print(f"jit: {jit * 1000:.1f} ms ({(aot - jit) * 1000:.1f} ms saved, {aot / jit:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
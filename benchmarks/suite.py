@@ -0,0 +1,162 @@
+"""
+Times the compiler on generated programs of several sizes: scanning in tokens per second, parsing in AST nodes per
+second, and lowering, codegen and the two together with parsing for a program the back end can compile. Results are
+written as JSON, so that a run can be compared with one from another commit. With --memory, each size is also
+compiled once more with allocations traced, for bytes per token and per AST node, what each phase left allocated and
+peak RSS.
+
+    python -m benchmarks.suite [--sizes N [N ...]] [--repeat N] [--seed N] [--memory] [--output results.json]
+                               [--compare old.json]
+"""
+import argparse
+import datetime
+import json
+import pathlib
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, Optional
+
+import llvmlite
+
+from benchmarks.generator import lowerable_program, program
+from spkt import ast_to_spkt
+from spkt.spkt_llvm import SpktToLLVM
+from spring import parse_text
+from spring.instrument import Instrumentation, instrumented
+from spring.spring_ast import count_nodes
+from spring.parser import parse
+from spring.scanner import scan
+
+# For each result, whether a bigger number is better
+METRICS = {
+    "scan_tokens_per_s": True,
+    "parse_nodes_per_s": True,
+    "lower_ms": False,
+    "codegen_ms": False,
+    "end_to_end_ms": False,
+}
+
+
+def best_time(func: Callable, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=pathlib.Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(functions: int, repeat: int, seed: int, temp_dir: pathlib.Path) -> Dict[str, float]:
+    text = program(functions, classes=functions // 10, overloads=functions // 10, seed=seed)
+    tokens = scan(text)
+    tree = parse(tokens)
+    scan_time = best_time(lambda: scan(text), repeat)
+    parse_time = best_time(lambda: parse(tokens), repeat)
+    nodes = count_nodes(tree)
+
+    path = temp_dir / f"lowerable{functions}.spng"
+    path.write_text(lowerable_program(functions, seed))
+    lowerable = parse_text(str(path), path.read_text())
+    modules = ast_to_spkt(lowerable, path)
+    lower_time = best_time(lambda: ast_to_spkt(lowerable, path), repeat)
+    codegen_time = best_time(lambda: SpktToLLVM().llvm_per_module(modules), repeat)
+    end_to_end_time = best_time(
+        lambda: SpktToLLVM().llvm_per_module(ast_to_spkt(parse_text(str(path), path.read_text()), path)), repeat)
+
+    return {
+        "functions": functions,
+        "tokens": len(tokens),
+        "nodes": nodes,
+        "scan_tokens_per_s": len(tokens) / scan_time,
+        "parse_nodes_per_s": nodes / parse_time,
+        "lower_ms": lower_time * 1000,
+        "codegen_ms": codegen_time * 1000,
+        "end_to_end_ms": end_to_end_time * 1000,
+    }
+
+
+def measure_memory(functions: int, seed: int, temp_dir: pathlib.Path) -> Dict[str, float]:
+    path = temp_dir / f"program{functions}.spng"
+    path.write_text(program(functions, classes=functions // 10, overloads=functions // 10, seed=seed))
+    lowerable_path = temp_dir / f"lowerable{functions}.spng"
+    lowerable_path.write_text(lowerable_program(functions, seed))
+
+    with instrumented(Instrumentation(memory=True)) as instrumentation:
+        parse_text(str(path), path.read_text())
+        lowerable = parse_text(str(lowerable_path), lowerable_path.read_text())
+        SpktToLLVM().llvm_per_module(ast_to_spkt(lowerable, lowerable_path))
+
+    report = instrumentation.memory_report()
+    report.update({f"{phase}_bytes": net for phase, net in instrumentation.memory_net.items()})
+    return report
+
+
+def compare(old: dict, new: dict):
+    old_results = {result["functions"]: result for result in old["results"]}
+    print(f"\ncompared with {old.get('commit') or 'unknown commit'} (above 1.00x is faster now)")
+    for result in new["results"]:
+        old_result = old_results.get(result["functions"])
+        if old_result is None:
+            continue
+        changes = []
+        for metric, bigger_is_better in METRICS.items():
+            speedup = result[metric] / old_result[metric]
+            changes.append(f"{metric} {speedup if bigger_is_better else 1 / speedup:.2f}x")
+        print(f"{result['functions']:>6} functions: " + ", ".join(changes))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[100, 400, 1600],
+                            help="numbers of functions, with a tenth as many classes and overloaded functions")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--memory", action="store_true", help="also measure memory, with allocations traced")
+    arg_parser.add_argument("--output", type=pathlib.Path, help="write the results here as JSON")
+    arg_parser.add_argument("--compare", type=pathlib.Path, help="results from an earlier run to compare with")
+    args = arg_parser.parse_args()
+
+    results = {
+        "commit": commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "llvmlite": llvmlite.__version__,
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for functions in args.sizes:
+            result = measure(functions, args.repeat, args.seed, pathlib.Path(temp_dir))
+            results["results"].append(result)
+            print(f"{functions:>6} functions: {result['tokens']:>9} tokens {result['scan_tokens_per_s']:>12,.0f}/s "
+                  f"scan, {result['nodes']:>8} nodes {result['parse_nodes_per_s']:>10,.0f}/s parse, "
+                  f"lower {result['lower_ms']:.1f} ms, codegen {result['codegen_ms']:.1f} ms, "
+                  f"end to end {result['end_to_end_ms']:.1f} ms")
+            if args.memory:
+                memory = result["memory"] = measure_memory(functions, args.seed, pathlib.Path(temp_dir))
+                print(f"{'':>16} {memory['bytes_per_token']:.0f} bytes per token, "
+                      f"{memory['bytes_per_node']:.0f} bytes per AST node, "
+                      f"peak RSS {memory['peak_rss'] / 2 ** 20:.1f} MiB")
+
+    if args.output is not None:
+        with args.output.open("w") as output_file:
+            json.dump(results, output_file, indent=1)
+    if args.compare is not None:
+        with args.compare.open("r") as compare_file:
+            compare(json.load(compare_file), results)
+
+
+if __name__ == "__main__":
+    main()
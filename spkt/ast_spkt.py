@@ -1,25 +1,127 @@
 import pathlib
-from typing import Dict, List, Union
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple, Union
 
-from spring import parse_text
+from spring import AstCache, SpringError, instrument, iter_tokens, parse, parse_text
+from spring.ast_cache import damaged_errors, dumps, loads
 from spring.spring_ast import *
 from . import spkt_nodes as spkt
+from .visitor import Visitor
 
 __all__ = ['to_spkt']
 
 
-class Visitor:
-    def visit(self, obj, *args, **kwargs):
+def parse_file(path: str, cache: Optional[AstCache]) -> Tuple[Optional[bytes], Optional[tuple]]:
+    """
+    Parse a module in a worker process of ModuleLoader.parse_imports. The program is sent back serialized by
+    spring.ast_cache, which is far cheaper than pickling it, or, if it doesn't parse, the error's message and place.
+    """
+    with open(path, "r") as program_file:
+        text = program_file.read()
+
+    data = cache.read(cache.key(text)) if cache is not None else None
+    if data is None:
         try:
-            meth = getattr(self, "visit_" + obj.__class__.__name__)
-        except AttributeError:
-            raise ValueError(f"(In {self.__class__.__qualname__}) "
-                             f"No Visitor implemented for class {obj.__class__.__qualname__}") from None
-        return meth(obj, *args, **kwargs)
+            data = dumps(parse(iter_tokens(text)))
+        except SpringError as e:
+            return None, (e.message, e.line, e.line_pos)
+        if cache is not None:
+            cache.write(cache.key(text), data)
+    return data, None
+
+
+class ModuleLoader:
+    """
+    Parses and lowers every module of a program once, however many other modules import it. `order` has the
+    modules in dependency order: each comes after all the modules it imports.
+
+    With more than one job, parse_imports parses all the modules a program imports in that many processes before
+    anything is lowered. Lowering still happens here, in import order, so the result doesn't depend on which
+    module finished parsing first.
+    """
+
+    def __init__(self, cache: AstCache = None, jobs: int = 1):
+        self.cache = cache
+        self.jobs = jobs
+        self.modules: Dict[pathlib.Path, spkt.Module] = {}
+        self.order: List[spkt.Module] = []
+        # The modules being lowered, each imported by the one before it
+        self.loading: List[pathlib.Path] = []
+        # Modules parse_imports has parsed, waiting to be lowered
+        self.programs: Dict[pathlib.Path, Program] = {}
+
+    @staticmethod
+    def imports(path: pathlib.Path, program: Program) -> List[pathlib.Path]:
+        return [path.parent / top_level.file for top_level in program.top_levels
+                if isinstance(top_level, Import) and top_level.file.endswith(".spng")]
+
+    def parse_imports(self, path: pathlib.Path, program: Program):
+        seen = {path.resolve()}
+        pending: Dict[Future, pathlib.Path] = {}
+
+        with ProcessPoolExecutor(self.jobs) as pool:
+            def submit(importer: pathlib.Path, importer_program: Program):
+                for import_path in self.imports(importer, importer_program):
+                    if import_path.resolve() not in seen:
+                        seen.add(import_path.resolve())
+                        pending[pool.submit(parse_file, str(import_path), self.cache)] = import_path
+
+            submit(path, program)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    import_path = pending.pop(future)
+                    data, error = future.result()
+                    if error is not None:
+                        pool.shutdown(cancel_futures=True)
+                        SpringError(*error).finish(str(import_path), import_path.read_text())
+                        raise Exception()
+                    try:
+                        imported = loads(data)
+                    except damaged_errors:
+                        # A damaged cache file, which program_from_file will notice and parse around
+                        continue
+                    self.programs[import_path.resolve()] = imported
+                    submit(import_path, imported)
+
+    def program_from_file(self, path: pathlib.Path):
+        program = self.programs.pop(path.resolve(), None)
+        if program is not None:
+            return program
+
+        if path.suffix == ".spng":
+            with path.open("r") as program_file:
+                text = program_file.read()
+
+            return parse_text(str(path), text, self.cache)
+        else:
+            raise Exception("Cannot")
+
+    def load(self, path: pathlib.Path, program: Program = None) -> spkt.Module:
+        key = path.resolve()
+        if key in self.modules:
+            return self.modules[key]
+        if key in self.loading:
+            cycle = self.loading[self.loading.index(key):] + [key]
+            raise spkt.SprocketError("Import cycle: " + " -> ".join(module_path.name for module_path in cycle))
+
+        if program is None:
+            program = self.program_from_file(path)
+        self.loading.append(key)
+        try:
+            with instrument.span("lower", module=path.name):
+                mod = AstToSpkt(self).compile(program, path)
+        finally:
+            self.loading.pop()
+
+        self.modules[key] = mod
+        self.order.append(mod)
+        return mod
 
 
 class AstToSpkt(Visitor):
-    def __init__(self):
+    def __init__(self, loader: ModuleLoader):
+        self.loader = loader
         self.funcs: Dict[str, spkt.FuncDecl] = {}
         self.namespaces: Dict[str, spkt.Namespace] = {}
 
@@ -29,26 +131,15 @@ class AstToSpkt(Visitor):
     def compile(self, node: Program, path: pathlib.Path):
         return self.visit(node, path=path)
 
-    @staticmethod
-    def program_from_file(path: pathlib.Path):
-        if path.suffix == ".spng":
-            with path.open("r") as program_file:
-                text = program_file.read()
-
-            return parse_text(str(path), text)
-        else:
-            raise Exception("Cannot")
-
     def visit_Program(self, node: Program, path: pathlib.Path):
         mod = spkt.Module(path.name, path)
 
         for top_level in node.top_levels:
             if isinstance(top_level, Import):
-                path = pathlib.Path(top_level.file)
-                if path.suffix == ".spng":
-                    # TODO
-                    other_program = self.program_from_file(path)
-                elif path.suffix == ".h":
+                import_path = pathlib.Path(top_level.file)
+                if import_path.suffix == ".spng":
+                    self.namespaces[import_path.stem] = self.loader.load(path.parent / import_path)
+                elif import_path.suffix == ".h":
                     if top_level.file == "test.h":
                         # test = spkt.Module("test")
                         #
@@ -89,6 +180,7 @@ class AstToSpkt(Visitor):
         with spkt.Builder(spkt_func.body, obj=self):
             for stmt in node.body:
                 self.visit(stmt)
+        instrument.count("spkt instructions", len(spkt_func.body.body))
 
     def visit_Name(self, node: Name):
         if node.name == "int":
@@ -137,9 +229,17 @@ class AstToSpkt(Visitor):
             raise Exception()
 
 
-def to_spkt(program: Program, path: Union[str, pathlib.Path]) -> List[spkt.Module]:
+def to_spkt(program: Program, path: Union[str, pathlib.Path], cache: AstCache = None,
+            jobs: int = 1) -> List[spkt.Module]:
+    """
+    The modules of the program whose main module is `program`, in dependency order, so `program`'s is last. With
+    more than one job, the imported modules are parsed in that many processes.
+    """
     if isinstance(path, str):
         path = pathlib.Path(path)
-    compiler = AstToSpkt()
-    mod = compiler.compile(program, path)
-    return [mod] + [spkt.Builtins]
+    loader = ModuleLoader(cache, jobs)
+    if jobs > 1:
+        with instrument.span("parse imports", jobs=jobs):
+            loader.parse_imports(path, program)
+    loader.load(path, program)
+    return [spkt.Builtins] + loader.order
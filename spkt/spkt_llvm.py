@@ -1,33 +1,180 @@
+import ctypes
+import hashlib
 import os
+import pathlib
 import subprocess
-from typing import Dict, List
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Collection, Dict, List, Optional, Set, Tuple, Union
 
+import llvmlite.binding as llvm
 import llvmlite.ir as ir
 
 import spkt.spkt_nodes as spkt
-
-__all__ = ["compile_spkt"]
-
-
-class Visitor:
-    def visit(self, obj, *args, **kwargs):
-        for base in obj.__class__.mro():
-            try:
-                meth = getattr(self, "visit_" + base.__name__)
-                break
-            except AttributeError:
-                pass
-        else:
-            raise ValueError(f"(In {self.__class__.__qualname__}) "
-                             f"No Visitor implemented for class {obj.__class__.__qualname__}") from None
-        return meth(obj, *args, **kwargs)
+from spkt.visitor import Visitor
+from spring import instrument
+from spring.ast_cache import FileCache
+
+__all__ = ["compile_spkt", "run_jit", "emit_object", "compile_c_object", "link", "ObjectCache", "Optimization",
+           "file_stem"]
+
+shared_flags = ['-shared', '-fPIC']
+
+
+def file_stem(path: pathlib.Path) -> str:
+    """A name for files made from the module at `path`, which modules of the same name elsewhere don't share"""
+    return f"{path.stem}-{hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:12]}"
+
+
+def symbol(func: spkt.FuncDecl, root: pathlib.Path) -> str:
+    """
+    The name `func` is linked by. C functions and `main` keep their own, while other functions are prefixed with the
+    path of their module relative to `root`, the main module's directory, so that two modules can each have a
+    function of the same name. Being relative, the names don't change when the program is moved, nor do the objects
+    the cache finds for it.
+    """
+    if isinstance(func.namespace, spkt.CModule) or func.name == "main":
+        return func.name
+    path = pathlib.Path(os.path.relpath(func.namespace.path.resolve(), root))
+    return f"{path.as_posix()}:{func.name}"
+
+
+class ObjectCache(FileCache):
+    """Object files, keyed by everything that went into compiling them"""
+    suffix = ".o"
+
+    @staticmethod
+    def key(*inputs: Union[str, bytes]) -> str:
+        digest = hashlib.sha256()
+        for data in inputs:
+            if isinstance(data, str):
+                data = data.encode()
+            # Hashed separately, so that inputs can't run into each other
+            digest.update(hashlib.sha256(data).digest())
+        return digest.hexdigest()
+
+
+class Optimization:
+    """
+    How hard to optimize: `opt_level` is 0 to 3, as in -O0 to -O3, and a `size_level` of 1 or 2 optimizes for size
+    instead, as -Os and -Oz do. `inline_threshold` and `vectorize` override what the level would choose. When
+    `dump_ir` or `dump_bitcode` is given, each optimized module is written there as text or as bitcode.
+    """
+    # What clang uses for -Os and -Oz
+    size_inline_thresholds = {1: 75, 2: 25}
+
+    def __init__(self, opt_level: int = 0, size_level: int = 0, inline_threshold: Optional[int] = None,
+                 vectorize: Optional[bool] = None, dump_ir: Union[str, pathlib.Path] = None,
+                 dump_bitcode: Union[str, pathlib.Path] = None):
+        if opt_level not in range(4):
+            raise ValueError(f"Optimization level must be 0 to 3, not {opt_level}")
+        if size_level not in range(3):
+            raise ValueError(f"Size level must be 0 to 2, not {size_level}")
+        self.opt_level = opt_level
+        self.size_level = size_level
+        self.inline_threshold = inline_threshold
+        self.vectorize = vectorize
+        self.dump_ir = pathlib.Path(dump_ir) if dump_ir is not None else None
+        self.dump_bitcode = pathlib.Path(dump_bitcode) if dump_bitcode is not None else None
+
+    def __str__(self):
+        return "-O" + ("0123"[self.opt_level], "s", "z")[self.size_level]
+
+    @property
+    def enabled(self) -> bool:
+        return self.opt_level > 0 or self.size_level > 0
+
+    @property
+    def dumps(self) -> bool:
+        return self.dump_ir is not None or self.dump_bitcode is not None
+
+    @property
+    def speed_level(self) -> int:
+        # Optimizing for size still needs the passes of -O2
+        return max(self.opt_level, 2) if self.size_level else self.opt_level
+
+    def settings(self) -> str:
+        """Everything that changes the code generated, for cache keys"""
+        return f"{self} inline={self.inline_threshold} vectorize={self.vectorize}"
+
+    def clang_flags(self) -> List[str]:
+        return [str(self)]
+
+    def target_machine(self, jit: bool = False) -> llvm.TargetMachine:
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+        target = llvm.Target.from_default_triple()
+        if jit:
+            return target.create_target_machine(opt=self.speed_level)
+        # Linked by clang, which makes position independent executables by default
+        return target.create_target_machine(opt=self.speed_level, reloc="pic", codemodel="default")
+
+    def tuning_options(self) -> llvm.PipelineTuningOptions:
+        options = llvm.create_pipeline_tuning_options(speed_level=self.speed_level)
+        if self.size_level:
+            options.inlining_threshold = self.size_inline_thresholds[self.size_level]
+            options.loop_unrolling = False
+            options.loop_vectorization = options.slp_vectorization = False
+        if self.inline_threshold is not None:
+            options.inlining_threshold = self.inline_threshold
+        if self.vectorize is not None:
+            options.loop_vectorization = options.slp_vectorization = self.vectorize
+        return options
+
+    def run(self, llvm_module: llvm.ModuleRef, target_machine: llvm.TargetMachine = None,
+            path: pathlib.Path = None) -> llvm.ModuleRef:
+        """
+        Optimize `llvm_module` in place with the default module pipeline for the level, which runs the function
+        simplification passes on each function itself. Dumps are named after `path`, the module's source, when given.
+        """
+        if target_machine is None:
+            target_machine = self.target_machine()
+        llvm_module.triple = target_machine.triple
+        llvm_module.data_layout = str(target_machine.target_data)
+        llvm_module.verify()
+
+        if self.enabled:
+            with instrument.span("optimize", module=llvm_module.name):
+                pass_builder = llvm.create_pass_builder(target_machine, self.tuning_options())
+                pass_builder.getModulePassManager().run(llvm_module, pass_builder)
+
+        stem = file_stem(path) if path is not None else pathlib.Path(llvm_module.name).stem
+        if self.dump_ir is not None:
+            self.dump_ir.mkdir(parents=True, exist_ok=True)
+            (self.dump_ir / f"{stem}.ll").write_text(str(llvm_module))
+        if self.dump_bitcode is not None:
+            self.dump_bitcode.mkdir(parents=True, exist_ok=True)
+            (self.dump_bitcode / f"{stem}.bc").write_bytes(llvm_module.as_bitcode())
+        return llvm_module
 
 
 class Scope:
-    def __init__(self):
+    """Values and types declared in one scope. Those not found here are looked up in `parent`, the enclosing scope"""
+
+    def __init__(self, parent: Optional["Scope"] = None):
+        self.parent = parent
         self.vars: Dict[spkt.Value, ir.Value] = {}
         self.types: Dict[spkt.TypeDecl, ir.Type] = {}
 
+    def lookup_var(self, node: spkt.Value) -> ir.Value:
+        scope = self
+        while scope is not None:
+            value = scope.vars.get(node)
+            if value is not None:
+                return value
+            scope = scope.parent
+        raise KeyError(f"Node {node} not in scope")
+
+    def lookup_type(self, node: spkt.TypeDecl) -> ir.Type:
+        scope = self
+        while scope is not None:
+            typ = scope.types.get(node)
+            if typ is not None:
+                return typ
+            scope = scope.parent
+        raise KeyError(f"Node {node} not in scope")
+
 
 class SpktToLLVM(Visitor):
     ir_Int = ir.IntType(32)
@@ -36,65 +183,140 @@ class SpktToLLVM(Visitor):
     def __init__(self):
         # noinspection PyTypeChecker
         self.builder: ir.IRBuilder = None
-        self.scopes: List[Scope] = []
+        # The innermost scope
+        self.scope: Optional[Scope] = None
 
         self.module = ir.Module()
-
-    def compile_modules(self, modules: List[spkt.Module], and_run=False):
-        llvm_mod = self.llvm_from_modules(modules)
-
-        passed = []
-
-        main_path = modules[0].path.with_suffix(".ll")
-
-        with main_path.open("w") as main_file:
-            main_file.write(str(llvm_mod))
-
-        passed += [main_path]
-
-        for mod in modules:
-            if isinstance(mod, spkt.CModule):
-                passed.append(str(mod.source_path))
-
-        if os.name == 'posix':
-            try:
-                subprocess.run(["clang",
-                                *passed,
-                                "-o", main_path.with_suffix(''),
-                                '-Wno-override-module'], check=True)
-            except subprocess.CalledProcessError:
-                raise Exception("Error compiling generated code") from None
-
-            main_path.unlink()
-
-            if and_run:
-                subprocess.run([f"./{main_path.with_suffix('')}"], check=True)
-
-            return main_path.with_suffix('')
-        else:
+        # Modules whose functions are only declared, as each module being generated uses them
+        self.external: Set[int] = set()
+        # The main module's directory, which symbols are named relative to
+        self.root = pathlib.Path()
+
+    def compile_modules(self, modules: List[spkt.Module], and_run=False, jobs: int = None,
+                        cache: ObjectCache = None, optimization: Optimization = None,
+                        output: Union[str, pathlib.Path] = None):
+        """
+        Compile each module to its own object file, then link them into an executable, by default named after the
+        main module. Spring modules are parsed once by LLVM, optimized, and emitted as objects in `jobs` processes,
+        each with its own LLVM context, while clang compiles the C modules. With one job, Spring modules are compiled
+        in this process. Objects found in `cache` aren't compiled again.
+        """
+        if optimization is None:
+            optimization = Optimization()
+        if os.name != 'posix':
             raise SystemError("Only support compilation to executable code on POSIX (perhaps even only mac os x)")
 
-    def llvm_from_modules(self, modules: List[spkt.Module]):
-        self.scopes.append(Scope())
-        self.scopes[-1].types[spkt.Int] = self.ir_Int
-        self.scopes[-1].types[spkt.Void] = self.ir_Void
+        with instrument.span("codegen"):
+            ir_modules = self.llvm_per_module(modules)
+        target_machine = optimization.target_machine()
+        # Modules come in dependency order, so the main one is last
+        output = pathlib.Path(output) if output is not None else modules[-1].path.with_suffix('')
+        c_flags = optimization.clang_flags()
+
+        with tempfile.TemporaryDirectory(prefix="spring-") as temp_dir:
+            temp_dir = pathlib.Path(temp_dir)
+
+            objects = [temp_dir / f"{n}.o" for n in range(len(modules))]
+            emitted: List[Tuple[Future, pathlib.Path, str]] = []
+            futures = []
+            # LLVM's context isn't safe to share between threads, so Spring modules are compiled in processes. They
+            # are started first, before the threads are, which forking alongside would be unsafe.
+            with (ProcessPoolExecutor(jobs) if jobs != 1 else nullcontext()) as processes, \
+                    ThreadPoolExecutor(jobs) as threads:
+                try:
+                    for mod, ir_module, obj in zip(modules, ir_modules, objects):
+                        if isinstance(mod, spkt.CModule):
+                            continue
+                        if processes is None:
+                            obj.write_bytes(emit_object(mod, ir_module, target_machine, optimization, cache))
+                            continue
+                        llvm_ir = ir_text(mod, ir_module)
+                        key = ObjectCache.key(optimization.settings(), target_machine.triple, llvm_ir)
+                        data = cached_object(cache, key, optimization)
+                        if data is None:
+                            future = processes.submit(object_from_ir, mod.name, mod.path, llvm_ir, optimization)
+                            emitted.append((future, obj, key))
+                        else:
+                            obj.write_bytes(data)
+
+                    for mod, obj in zip(modules, objects):
+                        if isinstance(mod, spkt.CModule):
+                            futures.append(threads.submit(compile_c_object, mod, obj, c_flags, cache))
+
+                    for future, obj, key in emitted:
+                        data = future.result()
+                        obj.write_bytes(data)
+                        if cache is not None:
+                            cache.write(key, data)
+                    for future in futures:
+                        future.result()
+                    link(objects, output)
+                except subprocess.CalledProcessError:
+                    raise Exception("Error compiling generated code") from None
+
+        if and_run:
+            with instrument.span("run"):
+                subprocess.run([str(output.resolve())], check=True)
+
+        return output
+
+    def declare_modules(self, modules: List[spkt.Module], ir_modules: List[ir.Module]):
+        self.scope = Scope(self.scope)
+        self.scope.types[spkt.Int] = self.ir_Int
+        self.scope.types[spkt.Void] = self.ir_Void
 
         data = []
-        for module in modules:
+        for module, ir_module in zip(modules, ir_modules):
             llvm_funcs = []
             for func in module.funcs.values():
                 func_type = ir.FunctionType(self.visit(func.ret.type),
                                             [self.visit(param.type) for param in func.params])
-                llvm_func = ir.Function(self.module, func_type, func.name)
-                self.scopes[-1].vars[func] = llvm_func
+                llvm_func = ir.Function(ir_module, func_type, symbol(func, self.root))
+                self.scope.vars[func] = llvm_func
                 llvm_funcs.append(llvm_func)
             data.append(llvm_funcs)
+        return data
 
+    def llvm_from_modules(self, modules: List[spkt.Module]):
+        # Modules come in dependency order, so the main one is last
+        self.root = modules[-1].path.resolve().parent
+        data = self.declare_modules(modules, [self.module] * len(modules))
         for llvm_funcs, module in zip(data, modules):
             self.visit(module, llvm_funcs)
 
         return self.module
 
+    def llvm_per_module(self, modules: List[spkt.Module], only: Collection[spkt.Module] = None) -> List[ir.Module]:
+        """
+        One LLVM module for each module, which declares the functions it uses from other modules. The ones for C
+        modules only hold declarations, as do those not in `only`, when it is given. Functions from those are only
+        declared in the modules that use them, rather than all of them up front.
+        """
+        ir_modules = [ir.Module(module.name) for module in modules]
+        self.root = modules[-1].path.resolve().parent
+        if only is not None:
+            # Modules compare by value, which is slow and not what is meant here
+            only_ids = {id(module) for module in only}
+            self.external = {id(module) for module in modules} - only_ids
+            generated = [(module, ir_module) for module, ir_module in zip(modules, ir_modules)
+                         if id(module) in only_ids]
+        else:
+            generated = list(zip(modules, ir_modules))
+
+        data = self.declare_modules([module for module, _ in generated], [ir_module for _, ir_module in generated])
+        for llvm_funcs, (module, ir_module) in zip(data, generated):
+            self.module = ir_module
+            self.visit(module, llvm_funcs)
+
+        return ir_modules
+
+    def declare(self, func: ir.Function) -> ir.Function:
+        """`func`, from another module, declared in the one being generated"""
+        declared = self.module.globals.get(func.name)
+        if declared is None:
+            declared = ir.Function(self.module, func.function_type, func.name)
+        return declared
+
     def visit_Module(self, node: spkt.Module, llvm_funcs):
         for llvm_func, func in zip(llvm_funcs, node.funcs.values()):
             self.visit(func, in_llvm=llvm_func)
@@ -102,13 +324,17 @@ class SpktToLLVM(Visitor):
     def visit_Function(self, node: spkt.Function, in_llvm: ir.Function = None):
         if in_llvm:
             func = in_llvm
+            instrument.count("LLVM functions")
             self.builder = ir.IRBuilder(func.append_basic_block("entry"))
-            self.scopes.append(Scope())
-            for n, param in enumerate(node.params):
-                self.scopes[-1].vars[param] = func.args[n]
+            self.scope = Scope(self.scope)
+            try:
+                for n, param in enumerate(node.params):
+                    self.scope.vars[param] = func.args[n]
 
-            for instr in node.body.body:
-                self.visit(instr)
+                for instr in node.body.body:
+                    self.visit(instr)
+            finally:
+                self.scope = self.scope.parent
         else:
             return self.visit_Value(node)
 
@@ -119,33 +345,151 @@ class SpktToLLVM(Visitor):
             return self.visit_Value(node)
 
     def visit_TypeDecl(self, node: spkt.TypeDecl):
-        for scope in self.scopes:
-            if node in scope.types:
-                return scope.types[node]
-        else:
-            raise KeyError(f"Node {node} not in scope")
+        return self.scope.lookup_type(node)
 
     def visit_Call(self, node: spkt.Call):
         return self.builder.call(self.visit(node.func), [self.visit(arg) for arg in node.args])
 
+    def declare_external(self, func: spkt.FuncDecl) -> ir.Function:
+        name = symbol(func, self.root)
+        declared = self.module.globals.get(name)
+        if declared is None:
+            func_type = ir.FunctionType(self.visit(func.ret.type), [self.visit(param.type) for param in func.params])
+            declared = ir.Function(self.module, func_type, name)
+        return declared
+
     def visit_Value(self, node: spkt.Value):
-        for scope in self.scopes:
-            if node in scope.vars:
-                return scope.vars[node]
-            # else:
-            #     print({id(key) for key in scope.vars.keys()}, id(node))
-        else:
-            # breakpoint()
-            raise KeyError(f"Node {node} not in scope")
+        if isinstance(node, spkt.FuncDecl) and id(node.namespace) in self.external:
+            return self.declare_external(node)
+        value = self.scope.lookup_var(node)
+        if isinstance(value, ir.Function) and value.module is not self.module:
+            value = self.declare(value)
+        return value
 
     def visit_IntConstant(self, node: spkt.IntConstant):
-        self.scopes[-1].vars[node.to] = self.ir_Int(node.val)
+        self.scope.vars[node.to] = self.ir_Int(node.val)
 
     def visit_Return(self, node: spkt.Return):
         self.builder.ret(self.visit(node.ret))
 
 
-def compile_spkt(modules: List[spkt.Module], and_run=False):
+def compile_spkt(modules: List[spkt.Module], and_run=False, jobs: int = None, cache: ObjectCache = None,
+                 optimization: Optimization = None, output: Union[str, pathlib.Path] = None):
     to_llvm = SpktToLLVM()
-    res = to_llvm.compile_modules(modules, and_run=and_run)
+    res = to_llvm.compile_modules(modules, and_run=and_run, jobs=jobs, cache=cache, optimization=optimization,
+                                  output=output)
     return res
+
+
+def ir_text(mod: spkt.Module, ir_module: ir.Module) -> str:
+    with instrument.span("print IR", module=mod.name):
+        return str(ir_module)
+
+
+def cached_object(cache: Optional[ObjectCache], key: str, optimization: Optimization) -> Optional[bytes]:
+    # Dumps are made as modules are compiled, so a cached object would leave a module out
+    return cache.read(key) if cache is not None and not optimization.dumps else None
+
+
+def object_from_ir(name: str, path: pathlib.Path, llvm_ir: str, optimization: Optimization,
+                   target_machine: llvm.TargetMachine = None) -> bytes:
+    """
+    Parse, optimize and emit a Spring module's IR. This is what compile_modules' worker processes run, so it only
+    takes what pickles, and makes its own target machine when not given one.
+    """
+    if target_machine is None:
+        target_machine = optimization.target_machine()
+    with instrument.span("parse IR", module=name):
+        llvm_module = llvm.parse_assembly(llvm_ir)
+    llvm_module.name = name
+    optimization.run(llvm_module, target_machine, path)
+    with instrument.span("emit object", module=name):
+        return target_machine.emit_object(llvm_module)
+
+
+def emit_object(mod: spkt.Module, ir_module: ir.Module, target_machine: llvm.TargetMachine,
+                optimization: Optimization, cache: ObjectCache = None) -> bytes:
+    """The object code for a Spring module, optimized, unless `cache` already has it"""
+    llvm_ir = ir_text(mod, ir_module)
+    key = ObjectCache.key(optimization.settings(), target_machine.triple, llvm_ir)
+    data = cached_object(cache, key, optimization)
+    if data is None:
+        data = object_from_ir(mod.name, mod.path, llvm_ir, optimization, target_machine)
+        if cache is not None:
+            cache.write(key, data)
+    return data
+
+
+def compile_c_object(mod: spkt.CModule, obj: pathlib.Path, flags: List[str], cache: ObjectCache = None):
+    """Compile a C module to the object file `obj` with clang, unless `cache` already has it"""
+    key = ObjectCache.key(" ".join(flags), mod.source_path.read_bytes(), mod.path.read_bytes())
+    data = cache.read(key) if cache is not None else None
+    if data is not None:
+        obj.write_bytes(data)
+        return
+    with instrument.span("compile C", module=mod.name):
+        subprocess.run(["clang", "-c", str(mod.source_path), "-o", str(obj), *flags], check=True)
+    if cache is not None:
+        cache.write(key, obj.read_bytes())
+
+
+def link(objects: List[pathlib.Path], output: pathlib.Path):
+    with instrument.span("link"):
+        subprocess.run(["clang", *map(str, objects), "-o", str(output)], check=True)
+
+
+def load_c_module(mod: spkt.CModule, temp_dir: pathlib.Path, cache: ObjectCache = None,
+                  optimization: Optimization = None):
+    """Build a C module into a shared object, unless `cache` has it, and load it into this process"""
+    flags = [*shared_flags, *optimization.clang_flags()] if optimization is not None else shared_flags
+    key = ObjectCache.key(" ".join(flags), mod.source_path.read_bytes(), mod.path.read_bytes())
+    path = temp_dir / f"{mod.name}.so"
+
+    data = cache.read(key) if cache is not None else None
+    if data is not None:
+        path.write_bytes(data)
+    else:
+        try:
+            with instrument.span("compile C", module=mod.name):
+                subprocess.run(["clang", *flags, str(mod.source_path), "-o", str(path)], check=True)
+        except subprocess.CalledProcessError:
+            raise Exception(f"Error compiling {mod.source_path}") from None
+        if cache is not None:
+            cache.write(key, path.read_bytes())
+
+    llvm.load_library_permanently(str(path))
+
+
+def run_jit(modules: List[spkt.Module], cache: ObjectCache = None, optimization: Optimization = None) -> int:
+    """
+    Compile the modules in this process with llvmlite's MCJIT and call their `main`, returning what it returns. The
+    C modules are loaded as shared objects for the JIT to link against.
+    """
+    if optimization is None:
+        optimization = Optimization()
+
+    with tempfile.TemporaryDirectory(prefix="spring-") as temp_dir:
+        for mod in modules:
+            if isinstance(mod, spkt.CModule):
+                load_c_module(mod, pathlib.Path(temp_dir), cache, optimization)
+
+    with instrument.span("codegen"):
+        ir_module = SpktToLLVM().llvm_from_modules(modules)
+    with instrument.span("print IR"):
+        llvm_ir = str(ir_module)
+    with instrument.span("parse IR"):
+        llvm_module = llvm.parse_assembly(llvm_ir)
+    llvm_module.name = modules[-1].name
+    target_machine = optimization.target_machine(jit=True)
+    optimization.run(llvm_module, target_machine, modules[-1].path)
+
+    with instrument.span("jit"):
+        engine = llvm.create_mcjit_compiler(llvm_module, target_machine)
+        engine.finalize_object()
+    main = ctypes.CFUNCTYPE(ctypes.c_int)(engine.get_function_address("main"))
+    with instrument.span("run"):
+        result = main()
+
+    # Output from the C modules is buffered by the C library, which won't be flushed until this process exits
+    ctypes.CDLL(None).fflush(None)
+    return result
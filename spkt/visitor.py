@@ -0,0 +1,32 @@
+from typing import Callable, Dict
+
+__all__ = ['Visitor']
+
+
+class Visitor:
+    """
+    Calls the `visit_<class name>` method for a node's class, or for the nearest of its bases that has one. Which
+    method that is gets worked out the first time each visitor class meets each node class, and is then kept in a
+    table on the visitor class.
+    """
+    _dispatch: Dict[type, Callable] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch = {}
+
+    def visit(self, obj, *args, **kwargs):
+        try:
+            meth = self._dispatch[obj.__class__]
+        except KeyError:
+            meth = self._resolve(obj.__class__)
+        return meth(self, obj, *args, **kwargs)
+
+    @classmethod
+    def _resolve(cls, node_cls: type) -> Callable:
+        for base in node_cls.__mro__:
+            meth = getattr(cls, "visit_" + base.__name__, None)
+            if meth is not None:
+                cls._dispatch[node_cls] = meth
+                return meth
+        raise ValueError(f"(In {cls.__qualname__}) No Visitor implemented for class {node_cls.__qualname__}")
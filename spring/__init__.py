@@ -1,14 +1,37 @@
+from . import instrument
+from .ast_cache import AstCache, default_cache
 from .parser import parse
-from .scanner import scan
+from .scanner import scan, iter_tokens
+from .spring_ast import count_nodes
 from .spring_error import SpringError
 
-__all__ = ['parse_text']
+__all__ = ['parse_text', 'AstCache', 'default_cache']
 
 
-def parse_text(path: str, text: str):
+def parse_text(path: str, text: str, cache: AstCache = None):
+    if cache is not None:
+        with instrument.span("read AST cache", path=path):
+            program = cache.get(text)
+        if program is not None:
+            instrument.count("AST cache hits")
+            return program
+
     try:
-        program = parse(scan(text))
+        if instrument.enabled():
+            # Scanned up front rather than as the parser goes, so that the two can be timed apart
+            with instrument.span("scan", path=path):
+                tokens = scan(text)
+            instrument.count("tokens", len(tokens))
+            with instrument.span("parse", path=path):
+                program = parse(tokens)
+                instrument.count("AST nodes", count_nodes(program))
+        else:
+            program = parse(iter_tokens(text))
     except SpringError as e:
         e.finish(path, text)
         raise Exception()
+
+    if cache is not None:
+        with instrument.span("write AST cache", path=path):
+            cache.put(text, program)
     return program
@@ -0,0 +1,5 @@
+import sys
+
+from spring.cli import main
+
+sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Parsed programs kept on disk, keyed by a hash of their source text and of the compiler itself, so that a file that
+hasn't changed since the last build is neither scanned nor parsed again.
+"""
+import gc
+import hashlib
+import marshal
+import os
+import pathlib
+import threading
+import zlib
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
+
+from spring import spring_ast
+from spring.spring_ast import Node, Program, child_fields
+
+__all__ = ['FileCache', 'AstCache', 'default_cache', 'compiler_version', 'dumps', 'loads', 'damaged_errors']
+
+
+# A serialized node refers to its class by its index here
+node_classes: List[type] = [getattr(spring_ast, name) for name in spring_ast.__all__ if name]
+class_ids: Dict[type, int] = {cls: n for n, cls in enumerate(node_classes)}
+
+TUPLE = -1
+
+# What loads raises for a file that was cut short or otherwise damaged
+damaged_errors = (ValueError, EOFError, TypeError, IndexError, zlib.error)
+
+
+@lru_cache()
+def compiler_version() -> str:
+    """Changes whenever any of the front end's source does, so trees from another version are never loaded"""
+    digest = hashlib.sha256()
+    for path in sorted(pathlib.Path(__file__).parent.glob("*.py")):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _encode(value, encoded: Dict[int, tuple]):
+    if isinstance(value, Node):
+        node = encoded.get(id(value))
+        if node is None:
+            cls = type(value)
+            node = encoded[id(value)] = (class_ids[cls], value.line, value.pos,
+                                         *[_encode(getattr(value, name), encoded) for name in child_fields(cls)])
+        return node
+    if isinstance(value, list):
+        return [_encode(item, encoded) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode(item, encoded) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return (TUPLE, *[_encode(item, encoded) for item in value])
+    return value
+
+
+def _decode(value, decoded: Dict[int, Node]):
+    typ = type(value)
+    if typ is tuple:
+        if value[0] == TUPLE:
+            return tuple(_decode(item, decoded) for item in value[1:])
+        node = decoded.get(id(value))
+        if node is None:
+            node = decoded[id(value)] = node_classes[value[0]](*[_decode(item, decoded) for item in value[3:]])
+            node.line = value[1]
+            node.pos = value[2]
+        return node
+    if typ is list:
+        return [_decode(item, decoded) for item in value]
+    if typ is dict:
+        return {key: _decode(item, decoded) for key, item in value.items()}
+    return value
+
+
+def dumps(program: Program) -> bytes:
+    """
+    Serialize a program, with node positions. Nodes become tuples of their class index, position and fields, which
+    marshal writes compactly and reads back much faster than the program could be parsed again. A node that appears
+    more than once, as macro arguments can, is stored once.
+    """
+    return zlib.compress(marshal.dumps(_encode(program, {})), 1)
+
+
+def loads(data: bytes) -> Program:
+    # Nothing built here can be garbage, and the collector would otherwise run over and over as the tuples and nodes
+    # pile up, which costs more than the loading itself
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _decode(marshal.loads(zlib.decompress(data)), {})
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# What the files in each cache directory add up to, as far as this process knows: their size when they were last
+# counted, plus what it wrote since. Kept here rather than on a FileCache, which is copied into worker processes for
+# every module they parse.
+_totals: Dict[pathlib.Path, int] = {}
+_totals_lock = threading.Lock()
+
+
+class FileCache:
+    """
+    Files stored under `directory` by key. Reading a file marks it as recently used, and when the files add up to
+    more than `max_bytes`, the least recently used ones are removed. The files are only listed the first time this
+    process writes to the directory and whenever what it wrote since takes them over `max_bytes`, so writing doesn't
+    cost more as the cache grows.
+    """
+    suffix = ""
+
+    def __init__(self, directory: Union[str, pathlib.Path], max_bytes: int = 256 * 2 ** 20):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> pathlib.Path:
+        return self.directory / (key + self.suffix)
+
+    def read(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def write(self, key: str, data: bytes):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        # Written under another name first, so a reader never sees half a file
+        temp_path = path.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+        temp_path.write_bytes(data)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(temp_path, path)
+
+        with _totals_lock:
+            total = _totals.get(self.directory)
+            if total is not None:
+                total = _totals[self.directory] = total + len(data) - replaced
+        if total is None or total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Count the files, removing the least recently used ones until they fit in `max_bytes`"""
+        entries = []
+        for path in self.directory.glob("*" + self.suffix):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        with _totals_lock:
+            _totals[self.directory] = total
+
+
+class AstCache(FileCache):
+    """Programs, as `dumps` serializes them, keyed by their source text and the compiler version"""
+    suffix = ".ast"
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(compiler_version().encode() + text.encode()).hexdigest()
+
+    def get(self, text: str) -> Optional[Program]:
+        key = self.key(text)
+        data = self.read(key)
+        if data is None:
+            return None
+        try:
+            return loads(data)
+        except damaged_errors:
+            self.path(key).unlink(missing_ok=True)
+            return None
+
+    def put(self, text: str, program: Program):
+        self.write(self.key(text), dumps(program))
+
+
+def default_cache() -> AstCache:
+    """The cache in $SPRING_CACHE_DIR, or in ~/.cache/spring"""
+    directory = os.environ.get("SPRING_CACHE_DIR") or pathlib.Path.home() / ".cache" / "spring"
+    return AstCache(pathlib.Path(directory) / "ast")
@@ -0,0 +1,281 @@
+"""
+The command line driver.
+
+    python -m spring check main.spng    parse the program and lower it to spkt, reporting any errors
+    python -m spring build main.spng    compile it to an executable in the build directory, -O0 to -O3, -Os or -Oz
+    python -m spring run main.spng      build it, then run it
+    python -m spring run --jit main.spng    or compile it in memory and run it without leaving the process
+    python -m spring watch main.spng    build it again each time one of its modules is saved, until interrupted
+
+Each command records what it read in a build manifest under --build-dir: every module and C file, with its
+modification time, size and hash, along with the compiler version and anything else that affects the output. When
+none of that has changed since the last successful run, the command does nothing. Modules that did change are the
+only ones scanned and parsed again, the rest come from the AST cache in the build directory.
+
+`watch` stays running and keeps everything it made in memory, so that a save only costs scanning and parsing the
+module again, lowering and compiling it and the modules that import it, and linking.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import pathlib
+import subprocess
+import sys
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from spring import AstCache, instrument, parse_text
+from spring.ast_cache import compiler_version
+from spring.spring_error import SpringError
+
+__all__ = ['main', 'Build']
+
+
+@lru_cache()
+def build_version() -> str:
+    """
+    Changes whenever the source of the front end or of the spkt back end does. The AST cache only needs the former,
+    but either can change what a build makes.
+    """
+    digest = hashlib.sha256(compiler_version().encode())
+    # Found without importing it, which would load LLVM
+    spkt_dir = pathlib.Path(importlib.util.find_spec("spkt").submodule_search_locations[0])
+    for path in sorted(spkt_dir.glob("*.py")):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def stamp(path: pathlib.Path) -> list:
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size, hashlib.sha256(path.read_bytes()).hexdigest()]
+
+
+def unchanged(path: pathlib.Path, old_stamp: list) -> bool:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    if [stat.st_mtime_ns, stat.st_size] == old_stamp[:2]:
+        return True
+    # Touched, but maybe not changed
+    return stat.st_size == old_stamp[1] and hashlib.sha256(path.read_bytes()).hexdigest() == old_stamp[2]
+
+
+class Build:
+    """The program whose main module is `source`, built in `build_dir`"""
+
+    def __init__(self, source: pathlib.Path, build_dir: pathlib.Path, jobs: int = 1, opt_level: str = "0",
+                 dump_ir: Optional[pathlib.Path] = None, dump_bitcode: Optional[pathlib.Path] = None):
+        self.source = source
+        self.build_dir = build_dir
+        self.jobs = jobs
+        self.opt_level = opt_level
+        self.dump_ir = dump_ir
+        self.dump_bitcode = dump_bitcode
+
+        path_hash = hashlib.sha256(str(source.resolve()).encode()).hexdigest()[:12]
+        self.manifest_path = build_dir / f"{source.stem}-{path_hash}.json"
+        try:
+            with self.manifest_path.open("r") as manifest_file:
+                self.manifest: Dict[str, dict] = json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+
+    def flags(self, stage: str) -> dict:
+        # The number of jobs doesn't change the output, so isn't here
+        if stage == "check":
+            return {"version": build_version()}
+        return {"version": build_version(), "opt_level": self.opt_level,
+                "dump_ir": str(self.dump_ir.resolve()) if self.dump_ir is not None else None,
+                "dump_bitcode": str(self.dump_bitcode.resolve()) if self.dump_bitcode is not None else None}
+
+    def optimization(self):
+        from spkt.spkt_llvm import Optimization
+
+        if self.opt_level in ("s", "z"):
+            return Optimization(2, "sz".index(self.opt_level) + 1, dump_ir=self.dump_ir,
+                                dump_bitcode=self.dump_bitcode)
+        return Optimization(int(self.opt_level), dump_ir=self.dump_ir, dump_bitcode=self.dump_bitcode)
+
+    def up_to_date(self, stage: str) -> bool:
+        record = self.manifest.get(stage)
+        if record is None or record["flags"] != self.flags(stage):
+            return False
+        if record["output"] is not None and not pathlib.Path(record["output"]).exists():
+            return False
+        return all(unchanged(pathlib.Path(path), old_stamp) for path, old_stamp in record["inputs"].items())
+
+    def record(self, stage: str, modules: list, output: Optional[pathlib.Path] = None):
+        from spkt.spkt_nodes import CModule
+
+        inputs = {}
+        for mod in modules:
+            paths = [mod.path, mod.source_path] if isinstance(mod, CModule) else [mod.path]
+            for path in paths:
+                inputs[str(path.resolve())] = stamp(path)
+        self.manifest[stage] = {
+            "flags": self.flags(stage),
+            "inputs": inputs,
+            "output": str(output.resolve()) if output is not None else None,
+        }
+
+        self.build_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = self.manifest_path.with_suffix(f".{os.getpid()}.tmp")
+        with temp_path.open("w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def lower(self) -> list:
+        from spkt import ast_to_spkt
+        from spkt.spkt_nodes import SprocketError
+
+        cache = AstCache(self.build_dir / "ast")
+        # Reported like the errors parsing reports, rather than with a traceback
+        try:
+            program = parse_text(str(self.source), self.source.read_text(), cache)
+            return ast_to_spkt(program, self.source, cache, self.jobs)
+        except SprocketError as e:
+            SpringError(str(e), 0, (0, 0)).finish(str(self.source), "")
+        except FileNotFoundError as e:
+            SpringError(f"Cannot read {e.filename}: {e.strerror}", 0, (0, 0)).finish(str(self.source), "")
+
+    def check(self):
+        if self.up_to_date("check") or self.up_to_date("build"):
+            return
+        self.record("check", self.lower())
+
+    def build(self) -> pathlib.Path:
+        if self.up_to_date("build"):
+            return pathlib.Path(self.manifest["build"]["output"])
+
+        from spkt import compile_spkt
+        from spkt.spkt_llvm import ObjectCache
+
+        modules = self.lower()
+        # Kept in the build directory, so nothing is written next to the sources
+        self.build_dir.mkdir(parents=True, exist_ok=True)
+        output = compile_spkt(modules, jobs=self.jobs, cache=ObjectCache(self.build_dir / "objects"),
+                              optimization=self.optimization(), output=self.build_dir / self.source.stem)
+        self.record("check", modules)
+        self.record("build", modules, output)
+        return output
+
+    def run(self, jit: bool = False) -> int:
+        if jit:
+            from spkt.spkt_llvm import ObjectCache, run_jit
+
+            modules = self.lower()
+            self.record("check", modules)
+            return run_jit(modules, ObjectCache(self.build_dir / "objects"), self.optimization())
+
+        output = self.build()
+        with instrument.span("run"):
+            return subprocess.run([str(output.resolve())]).returncode
+
+    def watch(self, interval: float = 0.2, and_run: bool = False):
+        from spkt.spkt_llvm import ObjectCache
+        from spring.watch import Watcher
+
+        self.build_dir.mkdir(parents=True, exist_ok=True)
+        output = self.build_dir / self.source.stem
+        watcher = Watcher(self.source, output, self.build_dir / "watch", self.optimization(),
+                          ObjectCache(self.build_dir / "objects"))
+
+        def on_build(modules: list):
+            # So that a build afterwards finds nothing to do
+            self.record("check", modules)
+            self.record("build", modules, output)
+            if and_run:
+                with instrument.span("run"):
+                    subprocess.run([str(output.resolve())])
+
+        sys.stderr.write(f"Watching {self.source} for changes, press Ctrl-C to stop\n")
+        try:
+            watcher.watch(interval, on_build)
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv: List[str] = None) -> int:
+    arg_parser = argparse.ArgumentParser(prog="spring", description="Check, build and run Spring programs")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    for command, description in [("check", "parse and lower a program, reporting any errors"),
+                                 ("build", "compile a program to an executable"),
+                                 ("run", "build a program, then run it"),
+                                 ("watch", "build a program each time one of its modules changes")]:
+        command_parser = commands.add_parser(command, help=description, description=description)
+        command_parser.add_argument("source", type=pathlib.Path, help="the program's main .spng file")
+        command_parser.add_argument("--build-dir", type=pathlib.Path, default=pathlib.Path(".spring-build"),
+                                    help="where the build manifest and caches are kept (default: .spring-build)")
+        if command != "watch":
+            command_parser.add_argument("-j", "--jobs", type=int, default=1,
+                                        help="parse and compile modules in this many processes")
+        if command != "check":
+            command_parser.add_argument("-O", dest="opt_level", choices=["0", "1", "2", "3", "s", "z"], default="0",
+                                        help="optimization level, as for clang: 0 to 3, s or z for size (default: 0)")
+            command_parser.add_argument("--dump-ir", type=pathlib.Path, metavar="DIR",
+                                        help="write the optimized LLVM IR of each module to DIR")
+            command_parser.add_argument("--dump-bitcode", type=pathlib.Path, metavar="DIR",
+                                        help="write the optimized LLVM bitcode of each module to DIR")
+        if command == "run":
+            command_parser.add_argument("--jit", action="store_true",
+                                        help="compile the program in memory and run it in this process")
+        if command == "watch":
+            command_parser.add_argument("--interval", type=float, default=0.2, metavar="SECONDS",
+                                        help="how often to look for changes (default: 0.2)")
+            command_parser.add_argument("--run", action="store_true", help="run the program after each build")
+        command_parser.add_argument("--profile", action="store_true",
+                                    help="time each phase and count what it makes, print a summary and write a "
+                                         "Chrome trace to the build directory. Runs with -j 1, as work done in other "
+                                         "processes isn't measured")
+        command_parser.add_argument("--profile-python", action="store_true",
+                                    help="as --profile, and also run each phase under cProfile, writing a .prof "
+                                         "file for each")
+        command_parser.add_argument("--profile-memory", nargs="?", const=True, choices=["sites"],
+                                    help="as --profile, and also trace allocations, reporting what each phase left "
+                                         "allocated, bytes per token and per AST node, and peak RSS. With =sites, "
+                                         "also which lines each phase allocated from, which is slow on large inputs")
+    args = arg_parser.parse_args(argv)
+
+    profiling = args.profile or args.profile_python or args.profile_memory
+    jobs = getattr(args, "jobs", 1)
+    if profiling and jobs != 1:
+        # Modules parsed or compiled in worker processes would be missing from the summary and the trace
+        sys.stderr.write("Profiling with -j 1, so that every module is measured\n")
+        jobs = 1
+    build = Build(args.source, args.build_dir, jobs, getattr(args, "opt_level", "0"),
+                  getattr(args, "dump_ir", None), getattr(args, "dump_bitcode", None))
+    if not profiling:
+        return run_command(build, args)
+
+    if args.profile_memory:
+        # Imported now, or everything the back end's import allocates would be traced, and slow every snapshot down
+        import spkt.spkt_llvm
+    instrumentation = instrument.Instrumentation(args.profile_python, args.profile_memory or False)
+    with instrument.instrumented(instrumentation):
+        status = run_command(build, args)
+
+    args.build_dir.mkdir(parents=True, exist_ok=True)
+    trace_path = args.build_dir / f"{args.source.stem}-trace.json"
+    instrumentation.write_trace(trace_path)
+    sys.stderr.write(instrumentation.summary() + "\n\n")
+    sys.stderr.write(f"Chrome trace written to {trace_path}\n")
+    if args.profile_python:
+        profile_dir = args.build_dir / "profile"
+        instrumentation.write_profiles(profile_dir)
+        sys.stderr.write(f"Profiles written to {profile_dir}\n")
+    return status
+
+
+def run_command(build: Build, args: argparse.Namespace) -> int:
+    if args.command == "check":
+        build.check()
+    elif args.command == "build":
+        print(build.build())
+    elif args.command == "watch":
+        build.watch(args.interval, args.run)
+    else:
+        return build.run(args.jit)
+    return 0
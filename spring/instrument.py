@@ -0,0 +1,311 @@
+"""
+Timing and counting for the phases of a compile. Nothing is recorded unless an Instrumentation is active:
+
+    with instrumented(Instrumentation()) as instrumentation:
+        ...
+    print(instrumentation.summary())
+    instrumentation.write_trace("trace.json")
+
+The compiler marks its phases with `span` and counts what it makes with `count`, which cost next to nothing while
+nothing is active. With `python_profile`, each phase is also run under its own cProfile profiler. A phase nested in
+another has its own profile, so each profile only holds what its phase itself did.
+
+With `memory`, allocations are traced with tracemalloc, and memory is measured whenever a phase starts or ends. What
+changed in between is put down to the innermost phase running then, so the summary can say what each phase left
+allocated, the most it had allocated at once, and how much that is per token and per AST node. Which lines allocated
+what comes from snapshots taken at the start and the end. With `memory="sites"`, a snapshot is taken at every phase
+boundary instead, to tell which lines each phase allocated from. A snapshot takes time in proportion to everything
+allocated, so that is only practical for smaller inputs, and the time is counted in the phases around them.
+"""
+import cProfile
+import json
+import os
+import pathlib
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ['Instrumentation', 'instrumented', 'span', 'count', 'enabled', 'peak_rss']
+
+
+class Span:
+    __slots__ = ('instrumentation', 'name', 'args', 'start', 'child_time', 'profile')
+
+    def __init__(self, instrumentation: "Instrumentation", name: str, args: dict):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.args = args
+        self.child_time = 0
+        self.profile: Optional[cProfile.Profile] = None
+
+    def __enter__(self):
+        self.instrumentation._enter(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        self.instrumentation._exit(self, end)
+
+
+class Instrumentation:
+    """The phases of a compile, and counts of what they made"""
+
+    def __init__(self, python_profile: bool = False, memory: Union[bool, str] = False):
+        if memory not in (False, True, "sites"):
+            raise ValueError(f"Memory must be False, True or 'sites', not {memory!r}")
+        self.python_profile = python_profile
+        self.memory = memory
+        self.start = time.perf_counter_ns()
+        # (name, args, thread, start, duration, self time), in nanoseconds
+        self.spans: List[tuple] = []
+        self.counters: Dict[str, int] = {}
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self._stacks = threading.local()
+        self._profiled_thread = threading.get_ident()
+
+        # By phase: the bytes it left allocated, the most it had allocated at once, and how much it raised peak RSS
+        self.memory_net: Dict[str, int] = {}
+        self.memory_peak: Dict[str, int] = {}
+        self.rss_growth: Dict[str, int] = {}
+        # Bytes left allocated by each phase at each line
+        self.memory_sites: Dict[str, Dict[Tuple[str, int], int]] = {}
+        # (time, bytes traced), for the trace
+        self.memory_samples: List[Tuple[int, int]] = []
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._traced = 0
+        self._rss = 0
+        self._started_tracing = False
+
+    def start_memory(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._snapshot = tracemalloc.take_snapshot()
+        self._traced = tracemalloc.get_traced_memory()[0]
+        self._rss = peak_rss()
+        tracemalloc.reset_peak()
+
+    def stop_memory(self):
+        self._memory_boundary("(between phases)")
+        if self.memory != "sites":
+            self._add_sites("(whole run)", tracemalloc.take_snapshot())
+        self._snapshot = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _memory_boundary(self, phase: str):
+        """Put what changed since the last boundary down to `phase`"""
+        if self.memory == "sites":
+            self._add_sites(phase, tracemalloc.take_snapshot())
+        traced, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        rss = peak_rss()
+
+        self.memory_net[phase] = self.memory_net.get(phase, 0) + traced - self._traced
+        self.memory_peak[phase] = max(self.memory_peak.get(phase, 0), peak)
+        self.rss_growth[phase] = self.rss_growth.get(phase, 0) + rss - self._rss
+        self.memory_samples.append((time.perf_counter_ns(), traced))
+        self._traced = traced
+        self._rss = rss
+
+    def _add_sites(self, phase: str, snapshot: tracemalloc.Snapshot):
+        sites = self.memory_sites.setdefault(phase, {})
+        for stat in snapshot.compare_to(self._snapshot, "lineno"):
+            frame = stat.traceback[0]
+            # The snapshots and records kept here aren't the compiler's
+            if stat.size_diff and frame.filename not in (__file__, tracemalloc.__file__):
+                sites[frame.filename, frame.lineno] = sites.get((frame.filename, frame.lineno), 0) + stat.size_diff
+        self._snapshot = snapshot
+
+    def span(self, name: str, **args) -> Span:
+        return Span(self, name, args)
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._stacks, "spans", None)
+        if stack is None:
+            stack = self._stacks.spans = []
+        return stack
+
+    def _enter(self, span: Span):
+        stack = self._stack()
+        if self._snapshot is not None and threading.get_ident() == self._profiled_thread:
+            self._memory_boundary(stack[-1].name if stack else "(between phases)")
+        if self.python_profile and threading.get_ident() == self._profiled_thread:
+            if stack and stack[-1].profile is not None:
+                stack[-1].profile.disable()
+            span.profile = self.profiles.get(span.name)
+            if span.profile is None:
+                span.profile = self.profiles[span.name] = cProfile.Profile()
+            span.profile.enable()
+        stack.append(span)
+
+    def _exit(self, span: Span, end: int):
+        stack = self._stack()
+        stack.pop()
+        if span.profile is not None:
+            span.profile.disable()
+            if stack and stack[-1].profile is not None:
+                stack[-1].profile.enable()
+
+        duration = end - span.start
+        if stack:
+            stack[-1].child_time += duration
+        self.spans.append((span.name, span.args, threading.get_ident(), span.start, duration,
+                           duration - span.child_time))
+        if self._snapshot is not None and threading.get_ident() == self._profiled_thread:
+            self._memory_boundary(span.name)
+
+    def memory_report(self) -> Dict[str, float]:
+        """Bytes per token and per AST node, from what scanning and parsing left allocated, and peak RSS in bytes"""
+        report = {"peak_rss": peak_rss()}
+        if self.counters.get("tokens") and "scan" in self.memory_net:
+            report["bytes_per_token"] = self.memory_net["scan"] / self.counters["tokens"]
+        if self.counters.get("AST nodes") and "parse" in self.memory_net:
+            report["bytes_per_node"] = self.memory_net["parse"] / self.counters["AST nodes"]
+        if self.memory_peak:
+            report["peak_traced"] = max(self.memory_peak.values())
+        return report
+
+    def summary(self, top_functions: int = 5) -> str:
+        wall = time.perf_counter_ns() - self.start
+        phases: Dict[str, List[int]] = {}
+        for name, _, _, _, duration, self_time in self.spans:
+            calls_total_self = phases.setdefault(name, [0, 0, 0])
+            calls_total_self[0] += 1
+            calls_total_self[1] += duration
+            calls_total_self[2] += self_time
+
+        lines = [f"{'phase':<20} {'calls':>6} {'self ms':>10} {'self %':>7}"]
+        for name, (calls, _, self_time) in sorted(phases.items(), key=lambda item: -item[1][2]):
+            lines.append(f"{name:<20} {calls:>6} {self_time / 1e6:>10.1f} {100 * self_time / wall:>6.1f}%")
+        lines.append(f"{'wall':<20} {'':>6} {wall / 1e6:>10.1f}")
+
+        if self.counters:
+            lines.append("")
+            width = max(map(len, self.counters))
+            for name, value in self.counters.items():
+                lines.append(f"{name:<{width}} {value:>10}")
+
+        if self.memory_net:
+            lines.append("")
+            lines.append(f"{'phase':<20} {'left MiB':>10} {'peak MiB':>10} {'RSS +MiB':>10}")
+            for name, net in sorted(self.memory_net.items(), key=lambda item: -item[1]):
+                lines.append(f"{name:<20} {net / 2 ** 20:>10.2f} {self.memory_peak[name] / 2 ** 20:>10.2f} "
+                             f"{self.rss_growth[name] / 2 ** 20:>10.2f}")
+
+            report = self.memory_report()
+            lines.append("")
+            if "bytes_per_token" in report:
+                lines.append(f"{report['bytes_per_token']:.0f} bytes per token")
+            if "bytes_per_node" in report:
+                lines.append(f"{report['bytes_per_node']:.0f} bytes per AST node")
+            if report["peak_rss"]:
+                lines.append(f"peak RSS {report['peak_rss'] / 2 ** 20:.1f} MiB")
+
+            sites = [(size, name, file, line) for name, phase_sites in self.memory_sites.items()
+                     for (file, line), size in phase_sites.items()]
+            lines.append("")
+            lines.append("Lines that left the most allocated:")
+            for size, name, file, line in sorted(sites, reverse=True)[:top_functions * 2]:
+                lines.append(f"    {size / 2 ** 20:>8.2f} MiB  {name:<20} {pathlib.Path(file).name}:{line}")
+
+        for name, profile in self.profiles.items():
+            stats = pstats.Stats(profile).stats
+            if not stats:
+                continue
+            lines.append("")
+            lines.append(f"{name}, by time spent in each function:")
+            # (primitive call count, call count, own time, cumulative time, callers) by (file, line, function)
+            slowest = sorted(stats.items(), key=lambda item: -item[1][2])[:top_functions]
+            for (file, line, function), (_, calls, own, *_) in slowest:
+                place = f"{pathlib.Path(file).name}:{line}({function})" if line else function
+                lines.append(f"    {own * 1000:>8.1f} ms {calls:>8} calls  {place}")
+        return "\n".join(lines)
+
+    def trace_events(self) -> List[dict]:
+        """The spans and counters as Chrome trace events, which chrome://tracing and Perfetto can open"""
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "spring"}}]
+        for name, args, thread, start, duration, _ in self.spans:
+            events.append({"name": name, "ph": "X", "pid": pid, "tid": thread, "ts": (start - self.start) / 1000,
+                           "dur": duration / 1000, "args": args})
+        for sample_time, traced in self.memory_samples:
+            events.append({"name": "memory", "ph": "C", "pid": pid, "ts": (sample_time - self.start) / 1000,
+                           "args": {"traced MiB": traced / 2 ** 20}})
+        if self.counters:
+            end = max((start + duration for _, _, _, start, duration, _ in self.spans), default=self.start)
+            events.append({"name": "counters", "ph": "C", "pid": pid, "ts": (end - self.start) / 1000,
+                           "args": self.counters})
+        return events
+
+    def write_trace(self, path: Union[str, pathlib.Path]):
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, trace_file)
+
+    def write_profiles(self, directory: Union[str, pathlib.Path]):
+        """Each phase's profile as `<phase>.prof`, for pstats or snakeviz"""
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(str(directory / (name.replace(" ", "_") + ".prof")))
+
+
+current: Optional[Instrumentation] = None
+
+_no_span = nullcontext()
+
+
+def enabled() -> bool:
+    return current is not None
+
+
+def span(name: str, **args):
+    if current is None:
+        return _no_span
+    return current.span(name, **args)
+
+
+def count(name: str, n: int = 1):
+    if current is not None:
+        current.count(name, n)
+
+
+@contextmanager
+def instrumented(instrumentation: Instrumentation = None):
+    """Record spans and counts in `instrumentation`, or in a new one, until the block ends"""
+    global current
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    previous = current
+    current = instrumentation
+    if instrumentation.memory:
+        instrumentation.start_memory()
+    try:
+        yield instrumentation
+    finally:
+        if instrumentation.memory:
+            instrumentation.stop_memory()
+        current = previous
+
+
+def peak_rss() -> int:
+    """The most memory this process has had resident, in bytes, or 0 where that can't be found"""
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In kilobytes, except on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
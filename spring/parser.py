@@ -1,10 +1,15 @@
 from __future__ import annotations
 
-from typing import List, Dict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, List, Dict, Iterable, Iterator, Optional, Tuple, Union
 
+from spring import instrument
 from spring.spring_ast import *
+from spring.spring_ast import child_fields
 from spring.spring_error import SpringError
-from spring.spring_token import Token
+from spring.spring_token import Kinds, Token, TokenKind, TokenTable
 
 ORDER = "AFTER scanner"
 
@@ -13,43 +18,139 @@ class ParseError(SpringError):
     pass
 
 
+class LookbackError(ParseError):
+    """Raised when the parser goes back to a token a `TokenBuffer` has already dropped, which is a bug in the parser"""
+
+
+# How tightly each infix operator binds, loosest first. `as` is a postfix cast but shares the loop, binding tighter
+# than any other operator. Prefix operators, calls and attribute accesses bind tighter still.
+binding_powers: Dict[TokenKind, int] = {
+    Kinds.EQ: 1, Kinds.NE: 1,
+    Kinds.LT: 2, Kinds.GT: 2, Kinds.LE: 2, Kinds.GE: 2,
+    Kinds.PLUS: 3, Kinds.MINUS: 3,
+    Kinds.STAR: 4, Kinds.SLASH: 4, Kinds.FLOOR_DIV: 4, Kinds.MOD: 4,
+    Kinds.AS: 5,
+}
+cast_power = binding_powers[Kinds.AS]
+unary_ops = frozenset([Kinds.NOT, Kinds.MINUS])
+literal_kinds = frozenset([Kinds.NUM, Kinds.HEX, Kinds.STR])
+
+
+class TokenBuffer:
+    """
+    Tokens pulled from the scanner as the parser asks for them. The parser looks at most a couple of tokens back from
+    the furthest one it has read, so only the last `window` tokens before that are kept; anything older is dropped to
+    keep memory constant, except from where `hold` was asked to keep them. Going back further raises `LookbackError`.
+    """
+
+    def __init__(self, source: Iterator[Token], window: int = 64):
+        self._source = source
+        self._tokens: List[Token] = []
+        self._start = 0
+        self.window = window
+        # Where the parser may yet go back to, however far that is
+        self._held: List[int] = []
+
+    @contextmanager
+    def hold(self, index: int):
+        """Keep every token from `index` on until the block ends"""
+        self._held.append(index)
+        try:
+            yield
+        finally:
+            self._held.remove(index)
+
+    def __getitem__(self, index: int) -> Token:
+        tokens = self._tokens
+        i = index - self._start
+        if i < 0:
+            last = tokens[-1]
+            raise LookbackError(f"Internal error: token {index} was already dropped from the buffer, the parser went "
+                                f"back more than {self.window} tokens", last.line, last.pos)
+        while i >= len(tokens):
+            if self._source is None:
+                raise IndexError("no more tokens")
+            token = next(self._source, None)
+            if token is None:
+                self._source = None
+                raise IndexError("no more tokens")
+            tokens.append(token)
+            if len(tokens) > 2 * self.window:
+                drop = len(tokens) - self.window
+                if self._held:
+                    drop = min(drop, min(self._held) - self._start)
+                if drop > 0:
+                    del tokens[:drop]
+                    self._start += drop
+                    i -= drop
+        return tokens[i]
+
+
+EOF_TOKEN = Token(Kinds.EOF, "\0", 0, (0, 0))
+
+
 class Stream:
-    def __init__(self, tokens: List[Token], macro_symbols: Dict[str, Dict[str, Node]] = None):
+    """
+    An immutable cursor into a shared sequence of tokens. Advancing creates a new cursor one token further along,
+    so old streams stay valid and advancing costs the same no matter how many tokens are left.
+    """
+    __slots__ = ("tokens", "index", "curr", "macro_symbols")
+
+    def __init__(self, tokens: Union[List[Token], TokenTable, TokenBuffer], macro_symbols: Dict[str, Dict[str, Node]] = None,
+                 index: int = 0):
         if macro_symbols is None:
             macro_symbols = {"stmt": {}, "expr": {}}
         else:
             assert "stmt" in macro_symbols and "expr" in macro_symbols
         self.tokens = tokens
         self.macro_symbols = macro_symbols
+        self.index = index
+        try:
+            self.curr: Token = tokens[index]
+        except IndexError:
+            self.curr: Token = EOF_TOKEN
 
-    @property
-    def curr(self) -> Token:
+    def _at(self, index: int) -> Stream:
+        stream = Stream.__new__(Stream)
+        stream.tokens = self.tokens
+        stream.macro_symbols = self.macro_symbols
+        stream.index = index
         try:
-            return self.tokens[0]
+            stream.curr = self.tokens[index]
         except IndexError:
-            return Token("\0", "\0", 0, (0, 0))
+            stream.curr = EOF_TOKEN
+        return stream
 
     def advance(self):
-        return Stream(self.tokens[1:], self.macro_symbols), self.tokens[0]
+        if self.curr is EOF_TOKEN:
+            raise IndexError("Cannot advance past the end of the stream")
+        return self._at(self.index + 1), self.curr
 
-    def expect(self, typ: str):
-        if self.curr.type == typ:
+    def expect(self, kind: TokenKind):
+        if self.curr.kind == kind:
             return self.advance()
         else:
-            raise self.error(f"Expected a '{typ}' token, got a '{self.curr.type}' token instead")
+            raise self.error(f"Expected a '{kind.type}' token, got a '{self.curr.type}' token instead")
 
     def error(self, msg):
         raise ParseError(msg, self.curr.line, self.curr.pos)
 
     def is_empty(self):
-        return len(self.tokens) == 0
+        return self.curr is EOF_TOKEN
+
+    def hold(self):
+        """Keep the tokens from this stream's on while the block runs, so that the parser can go back to it"""
+        if isinstance(self.tokens, TokenBuffer):
+            return self.tokens.hold(self.index)
+        return nullcontext()
 
 
 def parsing_method(func):
     def _wrapper(self, stream: Stream):
         new_stream, node = func(self, stream)
-        if node is not None:
-            node.place(stream.curr.line, stream.curr.pos)
+        if node is not None and node.line is None:
+            node.line = stream.curr.line
+            node.pos = stream.curr.pos
         return new_stream, node
     return _wrapper
 
@@ -57,144 +158,383 @@ def parsing_method(func):
 def static_parsing_method(func):
     def _wrapper(stream: Stream):
         new_stream, node = func(stream)
-        if node is not None:
-            node.place(stream.curr.line, stream.curr.pos)
+        if node is not None and node.line is None:
+            node.line = stream.curr.line
+            node.pos = stream.curr.pos
         return new_stream, node
 
     return _wrapper
 
 
 class Macro:
-    def __init__(self, start: str, call: List[Token], replace: List[Token]):
+    """
+    A macro definition. The call pattern is compiled once, here, into `pattern`: a (kind, text) pair for each token
+    the call must contain, and the rule name, "stmt" or "expr", for each argument. `params` holds the rule and the
+    $identifier each argument is bound to, in order.
+
+    The replacement is parsed into `template` the first time the macro is expanded, with a MacroHole for each
+    argument, and parsed again only once other macros have been defined since.
+    """
+
+    def __init__(self, start: str, call: List[Token], replace: List[Token], place: str):
         self.start = start
         self.call = call
         self.replace = replace
+        self.place = place
 
-    def apply(self, parser: Parser, stream: Stream):
-        # stream, start = stream.expect("ident")
-        # assert start.text == self.start
+        self.template: Optional[Node] = None
+        self.template_generation = -1
 
-        def get_else(li, ind, default=None):
-            try:
-                return li[ind]
-            except IndexError:
-                return default
+        self.pattern: List[Union[Tuple[TokenKind, str], str]] = []
+        self.params: List[Tuple[str, str]] = []
+        n = 1  # the start identifier is matched by whoever dispatched to the macro
+        while n < len(call):
+            call_token = call[n]
+            if not call_token.type.startswith("$"):
+                self.pattern.append((call_token.kind, call_token.text))
+                n += 1
+            elif (call_token.kind == Kinds.META_IDENT and n + 2 < len(call)
+                  and call[n + 1].kind == Kinds.COLON and call[n + 2].kind == Kinds.IDENT):
+                rule = call[n + 2]
+                if rule.text not in ("stmt", "expr"):
+                    raise ParseError(f"Macro argument must be a stmt or an expr, not {rule.text!r}",
+                                     rule.line, rule.pos)
+                self.pattern.append(rule.text)
+                self.params.append((rule.text, call_token.text))
+                n += 3
+            else:
+                raise ParseError(f"Macro argument must be of form $identifier:type, not {call_token.text!r}",
+                                 call_token.line, call_token.pos)
 
-        symbols = {"stmt": {}, "expr": {}}
 
-        call_iter = enumerate(iter(self.call))
-        for n, call_token in call_iter:
-            if not call_token.type.startswith("$"):
-                after_stream, token = stream.advance()
-                if not token == call_token:
-                    raise stream.error(f"Macro expected {call_token}, got {token}")
-                stream = after_stream
+class MacroTrie:
+    """
+    All the macros of one place that share a start identifier, merged on their common prefixes so that a use is
+    matched against every form in a single pass over its tokens. A node follows a literal token if one matches,
+    otherwise parses its argument if it has one, otherwise ends the macro found there. A form that ends where a longer
+    one goes on to an argument is still used when that argument doesn't parse.
+    """
+    __slots__ = ("tokens", "arg_rule", "arg_parse", "arg_next", "macro")
+
+    def __init__(self):
+        self.tokens: Dict[Tuple[TokenKind, str], MacroTrie] = {}
+        self.arg_rule: Optional[str] = None
+        self.arg_parse: Optional[Callable] = None
+        self.arg_next: Optional[MacroTrie] = None
+        self.macro: Optional[Macro] = None
+
+    def add(self, macro: Macro):
+        node = self
+        for step in macro.pattern:
+            if isinstance(step, str):
+                if node.arg_next is None:
+                    node.arg_rule = step
+                    node.arg_parse = getattr(Parser, "parse_" + step)
+                    node.arg_next = MacroTrie()
+                elif node.arg_rule != step:
+                    start = macro.call[0]
+                    raise ParseError(f"Forms of macro {macro.start!r} disagree on whether the argument here is a "
+                                     f"stmt or an expr", start.line, start.pos)
+                node = node.arg_next
+            else:
+                child = node.tokens.get(step)
+                if child is None:
+                    child = node.tokens[step] = MacroTrie()
+                node = child
+        # A later definition of the same form replaces the earlier one
+        node.macro = macro
+
+    def apply(self, parser: Parser, stream: Stream) -> (Stream, Macro, Dict[str, Dict[str, Node]]):
+        stream, _ = stream.advance()
+        node = self
+        args = []
+        while True:
+            token = stream.curr
+            child = node.tokens.get((token.kind, token.text))
+            if child is not None:
+                stream, _ = stream.advance()
+                node = child
+            elif node.arg_next is not None and node.macro is not None:
+                # A shorter form ends here, as in `log $x:expr` beside `log $x:expr $y:expr`, and is used if the
+                # argument doesn't parse, however many tokens that took to find out
+                with stream.hold():
+                    try:
+                        stream, arg = node.arg_parse(parser, stream)
+                    except ParseError:
+                        break
+                args.append(arg)
+                node = node.arg_next
+            elif node.arg_next is not None:
+                stream, arg = node.arg_parse(parser, stream)
+                args.append(arg)
+                node = node.arg_next
+            elif node.macro is not None:
+                break
             else:
-                type = call_token.type[1:]
-                if type == "ident":
-                    if (get_else(self.call, n + 1) and get_else(self.call, n + 2)
-                            and self.call[n + 1].type == ":" and self.call[n + 2].type == "ident"):
-                        rule = self.call[n + 2].text
-                        ident = call_token.text
-                        # ident, rule = call_token.text.split(" ")
-                        stream, node = getattr(parser, "parse_" + rule)(stream)
-                        symbols[rule][ident] = node
-                        next(call_iter)
-                        next(call_iter)
-                    else:
-                        raise ParseError(f"Macro argument must be of form $identifier:type, not {call_token.text!r}",
-                                         call_token.line, call_token.pos)
-                else:
-                    raise Exception()
-
-        macro_tokens = self.replace
-        macro_stream = Stream(macro_tokens, symbols)
-        return stream, macro_stream
+                expected = ", ".join(repr(Token(kind, text, 0, (0, 0))) for kind, text in node.tokens)
+                if len(node.tokens) > 1:
+                    expected = "one of " + expected
+                raise stream.error(f"Macro expected {expected}, got {token}")
+
+        macro = node.macro
+        symbols = {"stmt": {}, "expr": {}}
+        for (rule, ident), arg in zip(macro.params, args):
+            symbols[rule][ident] = arg
+        return stream, macro, symbols
+
+
+@dataclass(slots=True)
+class MacroHole(Node):
+    """Stands in for a macro argument in a macro's parsed replacement"""
+    rule: str
+    ident: str
+
+
+class NotATemplate(Exception):
+    """Raised when a macro's replacement parses differently depending on what its arguments are"""
+
+
+def fill_template(node, symbols: Dict[str, Dict[str, Node]], copies: Dict[int, Node]):
+    """
+    Copy a macro template with its holes replaced by the arguments in `symbols`. Arguments are used as they are, and
+    a node that appears more than once in the template is copied once, so the result shares nodes exactly where
+    parsing the replacement again would have.
+    """
+    cls = type(node)
+    if cls is list:
+        return [fill_template(item, symbols, copies) for item in node]
+    if cls is MacroHole:
+        return symbols[node.rule][node.ident]
+    if not isinstance(node, Node):
+        return node
+    names = child_fields(cls)
+
+    new = copies.get(id(node))
+    if new is None:
+        new = copies[id(node)] = cls.__new__(cls)
+        new.line = node.line
+        new.pos = node.pos
+        new._meta = None
+        for name in names:
+            setattr(new, name, fill_template(getattr(node, name), symbols, copies))
+    return new
+
+
+def span_key(tokens: Union[List[Token], TokenTable], start: int, stop: int):
+    """
+    Identifies the tokens [start, stop) by their text and their positions relative to the first one, so a span that
+    only moved to other lines has the same key.
+    """
+    if isinstance(tokens, TokenTable):
+        first = tokens.start(start)
+        return first - tokens.line_start(tokens.line(start)), tokens.text[first:tokens.end(stop - 1)]
+    else:
+        first_line = tokens[start].line
+        return tuple((token.kind, token.text, token.line - first_line, token.pos) for token in tokens[start:stop])
+
+
+@dataclass()
+class TopLevelSpan:
+    """A top level parsed by an incremental `Parser`, and what it was parsed from"""
+    length: int
+    key: Any
+    macro_key: Tuple
+    first_line: int
+    last_line: int
+    # The first and last line of each macro definition before it, which the nodes its expansions copied are placed on
+    macro_lines: Tuple[Tuple[int, int], ...]
+    node: TopLevel
+    # Every node of `node`, gathered the first time it has to be moved
+    nodes: Optional[List[Node]] = None
+
+
+def tree_nodes(tree) -> List[Node]:
+    """Every node in a tree, once each however many times it is shared"""
+    nodes = []
+    seen = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Node):
+            if id(node) not in seen:
+                seen.add(id(node))
+                nodes.append(node)
+                stack.extend([getattr(node, name) for name in child_fields(type(node))])
+        elif isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+    return nodes
+
+
+def shift_lines(nodes: List[Node], moves: List[Tuple[int, int, int]]):
+    """For each (first_line, last_line, delta) in `moves`, move the nodes placed on those lines by `delta` lines"""
+    for node in nodes:
+        line = node.line
+        if line is not None:
+            for first_line, last_line, delta in moves:
+                if first_line <= line <= last_line:
+                    node.line = line + delta
+                    break
 
 
 class Parser:
-    def __init__(self):
-        self.macros: Dict[str, Dict[str, Macro]] = {
-            "stmt": {},
-            "expr": {}
-        }
+    def __init__(self, incremental: bool = False):
+        self.reset_macros()
+        # Counts macro definitions, so macro templates parsed before the latest one are parsed again
+        self.macro_generation = 0
+
+        # An incremental parser remembers the top levels of the last program it parsed, by their first two tokens,
+        # and reuses any whose tokens and preceding macros are unchanged the next time
+        self.incremental = incremental
+        self.top_level_spans: Dict[Tuple[str, str], List[TopLevelSpan]] = {}
 
     def parse_program(self, stream: Stream) -> Program:
+        if self.incremental:
+            if isinstance(stream.tokens, TokenBuffer):
+                raise Exception("Incremental parsing needs all the tokens, not a TokenBuffer")
+            self.reset_macros()
+            previous, self.top_level_spans = self.top_level_spans, {}
+            macro_key = ()
+            macro_lines = ()
+
         top_levels = []
         while not stream.is_empty():
-            stream, top_level = self.parse_top_level(stream)
+            if self.incremental:
+                try:
+                    stream, top_level, macro_key, macro_lines = self.parse_top_level_incrementally(
+                        stream, previous, macro_key, macro_lines)
+                except SpringError:
+                    # Keep what is left of the previous parse for the next attempt
+                    for head, spans in previous.items():
+                        self.top_level_spans.setdefault(head, []).extend(spans)
+                    raise
+            else:
+                stream, top_level = self.parse_top_level(stream)
             if top_level is not None:
                 top_levels.append(top_level)
         program = Program(top_levels)
         program.place(0, (0, 0))
         return program
 
-    @parsing_method
-    def parse_top_level(self, stream: Stream) -> (Stream, TopLevel):
-        if stream.curr.type == 'class':
-            return self.parse_class(stream)
-        elif stream.curr.type == 'def':
-            return self.parse_function(stream)
-        elif stream.curr.type == 'macro':
-            stream = self.parse_macro(stream)
-            return stream, None
-        elif stream.curr.type == "import":
-            return self.parse_import(stream)
+    def parse_top_level_incrementally(self, stream: Stream, previous: Dict[Tuple[str, str], List[TopLevelSpan]],
+                                      macro_key: Tuple, macro_lines: Tuple) -> (Stream, TopLevel, Tuple, Tuple):
+        """
+        Parse one top level, or reuse the one parsed from the same tokens last time if the macros before it are the
+        same too. Macros are compared by their text alone, so a top level still matches after they moved, and the
+        nodes copied from their bodies are moved along with them.
+        """
+        tokens = stream.tokens
+        start = stream.index
+        head = (stream.curr.text, stream._at(start + 1).curr.text)
+
+        for span in previous.get(head, ()):
+            if (span.macro_key == macro_key and start + span.length <= len(tokens)
+                    and span_key(tokens, start, start + span.length) == span.key):
+                previous[head].remove(span)
+                line = stream.curr.line
+                # Most of the nodes are the top level's own, so its move is tried first
+                moves = [(span.first_line, span.last_line, line - span.first_line)] if line != span.first_line else []
+                moves.extend((old[0], old[1], new[0] - old[0]) for old, new in zip(span.macro_lines, macro_lines)
+                             if new != old)
+                if moves:
+                    if span.nodes is None:
+                        span.nodes = tree_nodes(span.node)
+                    shift_lines(span.nodes, moves)
+                    span.last_line += line - span.first_line
+                    span.first_line = line
+                    span.macro_lines = macro_lines
+                self.top_level_spans.setdefault(head, []).append(span)
+                return stream._at(start + span.length), span.node, macro_key, macro_lines
+
+        new_stream, top_level = self.parse_top_level(stream)
+        stop = new_stream.index
+        key = span_key(tokens, start, stop)
+        if top_level is None:
+            # A macro definition, which changes how everything after it parses
+            macro_key += (key,)
+            macro_lines += ((stream.curr.line, tokens[stop - 1].line),)
         else:
+            span = TopLevelSpan(stop - start, key, macro_key, stream.curr.line, tokens[stop - 1].line, macro_lines,
+                                top_level)
+            self.top_level_spans.setdefault(head, []).append(span)
+        return new_stream, top_level, macro_key, macro_lines
+
+    def reset_macros(self):
+        self.macros: Dict[str, Dict[str, MacroTrie]] = {
+            "stmt": {},
+            "expr": {}
+        }
+        # Statement macros get their own entries here, keyed by their start identifier
+        self.stmt_rules: Dict[Union[TokenKind, str], Callable] = dict(self.base_stmt_rules)
+
+    def parse_top_level(self, stream: Stream) -> (Stream, TopLevel):
+        rule = self.top_level_rules.get(stream.curr.kind)
+        if rule is None:
             raise stream.error(f"Cannot parse a top level statement from a '{stream.curr.type}' token")
+        return rule(self, stream)
 
     @parsing_method
     def parse_import(self, stream: Stream):
-        stream, _ = stream.expect("import")
-        stream, file = stream.expect("str")
+        stream, _ = stream.expect(Kinds.IMPORT)
+        stream, file = stream.expect(Kinds.STR)
         return stream, Import(file.text[1:-1])
 
     def parse_macro(self, stream: Stream) -> Stream:
-        stream, _ = stream.expect("macro")
+        stream, _ = stream.expect(Kinds.MACRO)
 
         macro_call = []
 
-        stream, _ = stream.expect("$(")
-        stream, start = stream.expect("ident")
+        stream, _ = stream.expect(Kinds.MACRO_LPAREN)
+        stream, start = stream.expect(Kinds.IDENT)
         macro_call.append(start)
-        while stream.curr.type != ")$":
+        while stream.curr.kind != Kinds.MACRO_RPAREN:
             stream, token = stream.advance()
             macro_call.append(token)
-        stream, _ = stream.expect(")$")
+        stream, _ = stream.expect(Kinds.MACRO_RPAREN)
 
-        stream, _ = stream.expect("=>")
-        stream, ret_token = stream.expect("ident")
+        stream, _ = stream.expect(Kinds.FAT_ARROW)
+        stream, ret_token = stream.expect(Kinds.IDENT)
         place = ret_token.text
-        stream, _ = stream.expect(":")
+        stream, _ = stream.expect(Kinds.COLON)
 
         macro_replace = []
 
-        stream, _ = stream.expect("$(")
-        while stream.curr.type != ")$":
+        stream, _ = stream.expect(Kinds.MACRO_LPAREN)
+        while stream.curr.kind != Kinds.MACRO_RPAREN:
             stream, token = stream.advance()
             macro_replace.append(token)
-        stream, _ = stream.expect(")$")
+        stream, _ = stream.expect(Kinds.MACRO_RPAREN)
 
-        macro = Macro(start.text, macro_call, macro_replace)
+        if place not in self.macros:
+            raise ParseError(f"Macros can only be a stmt or an expr, not {place!r}", ret_token.line, ret_token.pos)
+        macro = Macro(start.text, macro_call, macro_replace, place)
+        self.macro_generation += 1
 
-        self.macros[place][macro.start] = macro
+        trie = self.macros[place].get(macro.start)
+        if trie is None:
+            trie = self.macros[place][macro.start] = MacroTrie()
+            if place == "stmt":
+                self.stmt_rules[macro.start] = partial(Parser.parse_macro_stmt, trie=trie)
+        trie.add(macro)
 
-        stream, _ = stream.expect("endmacro")
+        stream, _ = stream.expect(Kinds.ENDMACRO)
 
         return stream
 
     @staticmethod
-    def arguments(start: str, stream: Stream, each, end: str, sep: str = ",") -> (Stream, List):
+    def arguments(start: TokenKind, stream: Stream, each, end: TokenKind,
+                  sep: Optional[TokenKind] = Kinds.COMMA) -> (Stream, List):
         args = []
         stream, _ = stream.expect(start)
         while True:
-            if stream.curr.type == end:
+            if stream.curr.kind == end:
                 break
             stream, arg = each(stream)
             args.append(arg)
-            if stream.curr.type == sep:
+            if stream.curr.kind == sep:
                 stream, _ = stream.advance()
-            elif sep == '':
+            elif sep is None:
                 pass
             else:
                 break
@@ -208,54 +548,54 @@ class Parser:
     @parsing_method
     def parse_generic(self, stream: Stream):
         stream, type = self.parse_dotted_name(stream)
-        while stream.curr.type == "<":
-            stream, args = self.arguments("<", stream, self.parse_type, ">")
+        while stream.curr.kind == Kinds.LT:
+            stream, args = self.arguments(Kinds.LT, stream, self.parse_type, Kinds.GT)
             type = Generic(type, args)
         return stream, type
 
     @parsing_method
     def parse_dotted_name(self, stream: Stream):
         stream, type = self.parse_name(stream)
-        while stream.curr.type == ".":
-            stream, _ = stream.expect(".")
-            stream, attr = stream.expect("ident")
+        while stream.curr.kind == Kinds.DOT:
+            stream, _ = stream.expect(Kinds.DOT)
+            stream, attr = stream.expect(Kinds.IDENT)
             type = GetName(type, attr.text)
         return stream, type
 
     @parsing_method
     def parse_name(self, stream: Stream):
-        stream, name = stream.expect("ident")
+        stream, name = stream.expect(Kinds.IDENT)
         type = Name(name.text)
         return stream, type
 
     @parsing_method
     def parse_function(self, stream: Stream):
-        stream, _ = stream.expect("def")
-        stream, name = stream.expect("ident")
+        stream, _ = stream.expect(Kinds.DEF)
+        stream, name = stream.expect(Kinds.IDENT)
 
         def parse_parameter(s: Stream):
-            s, param_name = s.expect("ident")
-            s, _ = s.expect(":")
+            s, param_name = s.expect(Kinds.IDENT)
+            s, _ = s.expect(Kinds.COLON)
             s, typ = self.parse_type(s)
             return s, (param_name.text, typ)
 
         def parse_tail(s: Stream):
-            s, arg_tuples = self.arguments("(", s, parse_parameter, ")")
+            s, arg_tuples = self.arguments(Kinds.LPAREN, s, parse_parameter, Kinds.RPAREN)
             args = dict(arg_tuples)
-            if s.curr.type == "->":
-                s, _ = s.expect("->")
+            if s.curr.kind == Kinds.ARROW:
+                s, _ = s.expect(Kinds.ARROW)
                 s, ret = self.parse_type(s)
             else:
                 ret = None
             body = []
-            s, _ = s.expect("{")
-            while not s.curr.type == "}":
+            s, _ = s.expect(Kinds.LBRACE)
+            while not s.curr.kind == Kinds.RBRACE:
                 s, stmt = self.parse_stmt(s)
                 body.append(stmt)
-            s, _ = s.expect("}")
+            s, _ = s.expect(Kinds.RBRACE)
             return s, (args, ret, body)
 
-        if stream.curr.type == "(":  # regular function:
+        if stream.curr.kind == Kinds.LPAREN:  # regular function:
             stream, init_args = parse_tail(stream)
             return stream, Function(name.text, *init_args)
         else:
@@ -264,41 +604,35 @@ class Parser:
                 s, overload_args = parse_tail(s)
                 return s, Overload(*overload_args)
 
-            stream, overloads = self.arguments("{", stream, parse_overload, "}", sep='')
+            stream, overloads = self.arguments(Kinds.LBRACE, stream, parse_overload, Kinds.RBRACE, sep=None)
             return stream, OverloadedFunction(name.text, overloads)
 
     @parsing_method
     def parse_class(self, stream: Stream) -> (Stream, Class):
-        stream, _ = stream.expect("class")
-        stream, name_token = stream.expect("ident")
+        stream, _ = stream.expect(Kinds.CLASS)
+        stream, name_token = stream.expect(Kinds.IDENT)
         name = name_token.text
 
-        if stream.curr.type == "<":
-            stream, type_vars = self.arguments("<", stream, self.parse_name, ">")
+        if stream.curr.kind == Kinds.LT:
+            stream, type_vars = self.arguments(Kinds.LT, stream, self.parse_name, Kinds.GT)
             type_vars = [type_var.name for type_var in type_vars]
         else:
             type_vars = []
 
-        if stream.curr.type == "(":
-            stream, bases = self.arguments("(", stream, self.parse_type, ")")
+        if stream.curr.kind == Kinds.LPAREN:
+            stream, bases = self.arguments(Kinds.LPAREN, stream, self.parse_type, Kinds.RPAREN)
         else:
             bases = []
 
         body = []
-        stream, _ = stream.expect("{")
-        while not stream.curr.type == "}":
-            if stream.curr.type == "attr":
-                stream, attr = self.parse_attr(stream)
-                body.append(attr)
-            elif stream.curr.type == "method":
-                stream, method = self.parse_method(stream)
-                body.append(method)
-            elif stream.curr.type == "new":
-                stream, constructor = self.parse_constructor(stream)
-                body.append(constructor)
-            else:
+        stream, _ = stream.expect(Kinds.LBRACE)
+        while not stream.curr.kind == Kinds.RBRACE:
+            rule = self.class_body_rules.get(stream.curr.kind)
+            if rule is None:
                 raise stream.error(f"Class body must contain only attrs, methods, and constructors")
-        stream, _ = stream.expect("}")
+            stream, class_stmt = rule(self, stream)
+            body.append(class_stmt)
+        stream, _ = stream.expect(Kinds.RBRACE)
         if type_vars:
             # noinspection PyArgumentList
             return stream, GenericClass(name, bases, body, type_vars)
@@ -307,85 +641,96 @@ class Parser:
 
     @parsing_method
     def parse_attr(self, stream: Stream) -> (Stream, Attr):
-        stream, _ = stream.expect("attr")
-        stream, name_token = stream.expect("ident")
+        stream, _ = stream.expect(Kinds.ATTR)
+        stream, name_token = stream.expect(Kinds.IDENT)
         name = name_token.text
-        if stream.curr.type == ":":
-            stream, _ = stream.expect(":")
+        if stream.curr.kind == Kinds.COLON:
+            stream, _ = stream.expect(Kinds.COLON)
             stream, type = self.parse_type(stream)
         else:
             type = None
-        stream, _ = stream.expect(";")
+        stream, _ = stream.expect(Kinds.SEMICOLON)
         return stream, Attr(name, type)
 
     @parsing_method
     def parse_method(self, stream: Stream) -> (Stream, Method):
-        stream, _ = stream.expect("method")
-        stream, name = stream.expect("ident")
+        stream, _ = stream.expect(Kinds.METHOD)
+        stream, name = stream.expect(Kinds.IDENT)
 
         def parse_parameter(s: Stream):
-            s, param_name = s.expect("ident")
-            s, _ = s.expect(":")
+            s, param_name = s.expect(Kinds.IDENT)
+            s, _ = s.expect(Kinds.COLON)
             s, typ = self.parse_type(s)
             return s, (param_name.text, typ)
 
-        stream, arg_tuples = self.arguments("(", stream, parse_parameter, ")")
+        stream, arg_tuples = self.arguments(Kinds.LPAREN, stream, parse_parameter, Kinds.RPAREN)
         args = dict(arg_tuples)
-        if stream.curr.type == "->":
-            stream, _ = stream.expect("->")
+        if stream.curr.kind == Kinds.ARROW:
+            stream, _ = stream.expect(Kinds.ARROW)
             stream, ret = self.parse_type(stream)
         else:
             ret = None
         body = []
-        stream, _ = stream.expect("{")
-        while not stream.curr.type == "}":
+        stream, _ = stream.expect(Kinds.LBRACE)
+        while not stream.curr.kind == Kinds.RBRACE:
             stream, stmt = self.parse_stmt(stream)
             body.append(stmt)
-        stream, _ = stream.expect("}")
+        stream, _ = stream.expect(Kinds.RBRACE)
         return stream, Method(name.text, args=args, ret=ret, body=body)
 
     @parsing_method
     def parse_constructor(self, stream: Stream):
-        stream, _ = stream.expect("new")
+        stream, _ = stream.expect(Kinds.NEW)
 
         def parse_parameter(s: Stream):
-            s, param_name = s.expect("ident")
-            s, _ = s.expect(":")
+            s, param_name = s.expect(Kinds.IDENT)
+            s, _ = s.expect(Kinds.COLON)
             s, typ = self.parse_type(s)
             return s, (param_name.text, typ)
 
-        stream, arg_tuples = self.arguments("(", stream, parse_parameter, ")")
+        stream, arg_tuples = self.arguments(Kinds.LPAREN, stream, parse_parameter, Kinds.RPAREN)
         args = dict(arg_tuples)
         body = []
-        stream, _ = stream.expect("{")
-        while not stream.curr.type == "}":
+        stream, _ = stream.expect(Kinds.LBRACE)
+        while not stream.curr.kind == Kinds.RBRACE:
             stream, stmt = self.parse_stmt(stream)
             body.append(stmt)
-        stream, _ = stream.expect("}")
+        stream, _ = stream.expect(Kinds.RBRACE)
         return stream, Constructor(args, body)
 
-    @parsing_method
     def parse_stmt(self, stream: Stream) -> (Stream, Stmt):
-        if stream.curr.type == "var":
-            return self.parse_var_stmt(stream)
-        elif stream.curr.type == "return":
-            return self.parse_return_stmt(stream)
-        elif stream.curr.type == "if":
-            return self.parse_if_stmt(stream)
-        elif stream.curr.type == "while":
-            return self.parse_while_stmt(stream)
-        elif stream.curr.type == "{":
-            return self.parse_block(stream)
-        elif stream.curr.type == "ident" and stream.curr.text in self.macros["stmt"]:
-            macro = self.macros["stmt"][stream.curr.text]
-            stream, macro_stream = macro.apply(self, stream)
-            return stream, self.parse_stmt(macro_stream)[1]
-        elif stream.curr.type == "$ident" and stream.curr.text in stream.macro_symbols["stmt"]:
-            # if stream.curr.text in stream.macro_symbols["stmt"]:
+        # Statements are dispatched on their first token's kind, or on its text for identifiers, which may start a
+        # statement macro. Anything else is an expression statement.
+        curr = stream.curr
+        rule = self.stmt_rules.get(curr.text if curr.kind == Kinds.IDENT else curr.kind)
+        if rule is None:
+            return self.parse_expr_stmt(stream)
+        return rule(self, stream)
+
+    def parse_macro_stmt(self, stream: Stream, trie: MacroTrie) -> (Stream, Stmt):
+        stream, macro, symbols = trie.apply(self, stream)
+        return stream, self.expand_macro(macro, symbols)
+
+    def expand_macro(self, macro: Macro, symbols: Dict[str, Dict[str, Node]]) -> Node:
+        instrument.count("macro expansions")
+        rule = self.parse_stmt if macro.place == "stmt" else self.parse_expr
+        if macro.template_generation != self.macro_generation:
+            holes = {"stmt": {}, "expr": {}}
+            for param_rule, ident in macro.params:
+                holes[param_rule][ident] = MacroHole(param_rule, ident)
+            try:
+                macro.template = rule(Stream(macro.replace, holes))[1]
+            except NotATemplate:
+                macro.template = None
+            macro.template_generation = self.macro_generation
+        if macro.template is None:
+            return rule(Stream(macro.replace, symbols))[1]
+        return fill_template(macro.template, symbols, {})
+
+    def parse_stmt_symbol(self, stream: Stream) -> (Stream, Stmt):
+        if stream.curr.text in stream.macro_symbols["stmt"]:
             stream, ident = stream.advance()
             return stream, stream.macro_symbols["stmt"][ident.text]
-        elif stream.curr.type == "del":
-            return self.parse_delete(stream)
         # else:
         #     raise stream.error(f"Statement meta-identifier {stream.curr.text} is not defined")
         else:
@@ -393,30 +738,30 @@ class Parser:
 
     @parsing_method
     def parse_delete(self, stream: Stream):
-        stream, _ = stream.expect("del")
+        stream, _ = stream.expect(Kinds.DEL)
         stream, obj = self.parse_expr(stream)
-        stream, _ = stream.expect(";")
+        stream, _ = stream.expect(Kinds.SEMICOLON)
         return stream, DeleteStmt(obj)
 
     @parsing_method
     def parse_block(self, stream: Stream):
-        stream, _ = stream.expect("{")
+        stream, _ = stream.expect(Kinds.LBRACE)
         body = []
-        while not stream.curr.type == "}":
+        while not stream.curr.kind == Kinds.RBRACE:
             stream, stmt = self.parse_stmt(stream)
             body.append(stmt)
-        stream, _ = stream.expect("}")
+        stream, _ = stream.expect(Kinds.RBRACE)
         return stream, Block(body)
 
     @parsing_method
     def parse_if_stmt(self, stream: Stream):
-        stream, _ = stream.expect("if")
-        stream, _ = stream.expect("(")
+        stream, _ = stream.expect(Kinds.IF)
+        stream, _ = stream.expect(Kinds.LPAREN)
         stream, cond = self.parse_expr(stream)
-        stream, _ = stream.expect(")")
+        stream, _ = stream.expect(Kinds.RPAREN)
         stream, then_do = self.parse_stmt(stream)
-        if stream.curr.type == 'else':
-            stream, _ = stream.expect("else")
+        if stream.curr.kind == Kinds.ELSE:
+            stream, _ = stream.expect(Kinds.ELSE)
             stream, else_do = self.parse_stmt(stream)
         else:
             else_do = Block([])
@@ -424,173 +769,178 @@ class Parser:
 
     @parsing_method
     def parse_while_stmt(self, stream: Stream):
-        stream, _ = stream.expect("while")
-        stream, _ = stream.expect("(")
+        stream, _ = stream.expect(Kinds.WHILE)
+        stream, _ = stream.expect(Kinds.LPAREN)
         stream, cond = self.parse_expr(stream)
-        stream, _ = stream.expect(")")
+        stream, _ = stream.expect(Kinds.RPAREN)
         stream, body = self.parse_stmt(stream)
         return stream, WhileStmt(cond, body)
 
     @parsing_method
     def parse_var_stmt(self, stream: Stream):
-        stream, _ = stream.expect("var")
-        stream, var = stream.expect("ident")
+        stream, _ = stream.expect(Kinds.VAR)
+        stream, var = stream.expect(Kinds.IDENT)
 
-        stream, _ = stream.expect(":")
+        stream, _ = stream.expect(Kinds.COLON)
 
         stream, typ = self.parse_type(stream)
 
-        if stream.curr.type == "=":
-            stream, _ = stream.expect("=")
+        if stream.curr.kind == Kinds.ASSIGN:
+            stream, _ = stream.expect(Kinds.ASSIGN)
             stream, val = self.parse_expr(stream)
         else:
             val = None
-        stream, _ = stream.expect(";")
+        stream, _ = stream.expect(Kinds.SEMICOLON)
         return stream, VarStmt(var.text, typ, val)
 
     @parsing_method
     def parse_return_stmt(self, stream: Stream):
-        stream, _ = stream.expect("return")
-        if stream.curr.type == ";":
-            stream, _ = stream.expect(";")
+        stream, _ = stream.expect(Kinds.RETURN)
+        if stream.curr.kind == Kinds.SEMICOLON:
+            stream, _ = stream.expect(Kinds.SEMICOLON)
             # noinspection PyTypeChecker
             return stream, ReturnStmt(None)
         stream, expr = self.parse_expr(stream)
-        stream, _ = stream.expect(";")
+        stream, _ = stream.expect(Kinds.SEMICOLON)
         return stream, ReturnStmt(expr)
 
     @parsing_method
     def parse_expr_stmt(self, stream: Stream):
         stream, expr = self.parse_expr(stream)
-        stream, _ = stream.expect(";")
+        stream, _ = stream.expect(Kinds.SEMICOLON)
         return stream, ExprStmt(expr)
 
-    @parsing_method
     def parse_expr(self, stream: Stream):
-        # if stream.curr.type == "ident":
-        #     var = stream.curr.text
-        #     if var in self.macros["expr"]:
-        #         macro = self.macros["expr"][var]
-        #         stream, macro_stream = macro.apply(self, stream)
-        #         return stream, self.parse_expr(macro_stream)[1]
-
-        return self.parse_assignment(stream)
-
-    @parsing_method
-    def parse_assignment(self, stream: Stream):
-        stream, expr = self.parse_equality(stream)
-        if stream.curr.type == "=":
+        # Every node an expression produces is placed as soon as it's built, so none of the expression methods need
+        # to be wrapped with parsing_method
+        start = stream.curr
+        stream, expr = self.parse_binary(stream, 0)
+        if stream.curr.kind == Kinds.ASSIGN:
             if isinstance(expr, GetVar):
-                stream, _ = stream.expect("=")
-                stream, right = self.parse_assignment(stream)
+                stream, _ = stream.advance()
+                stream, right = self.parse_expr(stream)
                 expr = SetVar(expr.var, right)
             elif isinstance(expr, GetAttr):
-                stream, _ = stream.expect("=")
-                stream, right = self.parse_assignment(stream)
+                stream, _ = stream.advance()
+                stream, right = self.parse_expr(stream)
                 expr = SetAttr(expr.obj, expr.attr, right)
+            elif isinstance(expr, MacroHole):
+                # Whether this is a SetVar or a SetAttr depends on the argument
+                raise NotATemplate()
             else:
                 stream.error(f"Left-hand side of an assignment must be a variable or attribute")
-
+            expr.place(start.line, start.pos)
         return stream, expr
 
-    @staticmethod
-    def parse_bin_op(stream: Stream, ops: List[str], lower) -> (Stream, Expr):
-        stream, expr = lower(stream)
-        while stream.curr.type in ops:
-            start = stream.curr.line, stream.curr.pos
-            stream, op = stream.advance()
-            stream, right = lower(stream)
-            expr = BinOp(left=expr, op=op.text, right=right)
-            expr.place(*start)
-        return stream, expr
-
-    @parsing_method
-    def parse_equality(self, stream: Stream) -> (Stream, BinOp):
-        return self.parse_bin_op(stream, ["==", "!="], self.parse_comparison)
-
-    @parsing_method
-    def parse_comparison(self, stream: Stream) -> (Stream, BinOp):
-        return self.parse_bin_op(stream, ["<", ">", "<=", ">="], self.parse_addition)
-
-    @parsing_method
-    def parse_addition(self, stream: Stream) -> (Stream, BinOp):
-        return self.parse_bin_op(stream, ["+", "-"], self.parse_multiplication)
-
-    @parsing_method
-    def parse_multiplication(self, stream: Stream) -> (Stream, BinOp):
-        return self.parse_bin_op(stream, ["*", "/", "//", "%"], self.parse_cast)
-
-    @parsing_method
-    def parse_cast(self, stream: Stream):
+    def parse_binary(self, stream: Stream, min_power: int) -> (Stream, Expr):
+        """Parse a chain of infix operators that bind tighter than `min_power`, and the casts between them"""
         stream, expr = self.parse_unary(stream)
-        while stream.curr.type == "as":
-            start = stream.curr.line, stream.curr.pos
-            stream, _ = stream.expect("as")
-            stream, typ = self.parse_type(stream)
-            expr = Cast(expr, typ)
-            expr.place(*start)
-        return stream, expr
-
-    @parsing_method
-    def parse_unary(self, stream: Stream) -> (Stream, Unary):
-        if stream.curr.type in ("!", "-"):
-            stream, op = stream.advance()
+        while True:
+            op = stream.curr
+            power = binding_powers.get(op.kind)
+            if power is None or power <= min_power:
+                return stream, expr
+            stream, _ = stream.advance()
+            if power == cast_power:
+                stream, typ = self.parse_type(stream)
+                expr = Cast(expr, typ)
+            else:
+                stream, right = self.parse_binary(stream, power)
+                expr = BinOp(left=expr, op=op.text, right=right)
+            expr.place(op.line, op.pos)
+
+    def parse_unary(self, stream: Stream) -> (Stream, Expr):
+        op = stream.curr
+        if op.kind in unary_ops:
+            stream, _ = stream.advance()
             stream, right = self.parse_unary(stream)
-            return Unary(op.text, right)
+            expr = Unary(op.text, right)
+            expr.place(op.line, op.pos)
+            return stream, expr
         else:
             return self.parse_call(stream)
 
-    @parsing_method
     def parse_call(self, stream: Stream):
         stream, expr = self.parse_primary(stream)
         while not stream.is_empty():
-            start = stream.curr.line, stream.curr.pos
-            if stream.curr.type == "(":
-                stream, args = self.arguments("(", stream, self.parse_expr, ")")
+            start = stream.curr
+            if start.kind == Kinds.LPAREN:
+                stream, args = self.arguments(Kinds.LPAREN, stream, self.parse_expr, Kinds.RPAREN)
                 expr = Call(expr, args)
-            elif stream.curr.type == ".":
-                stream, _ = stream.expect(".")
-                stream, attr = stream.expect("ident")
+            elif start.kind == Kinds.DOT:
+                stream, _ = stream.advance()
+                stream, attr = stream.expect(Kinds.IDENT)
                 expr = GetAttr(expr, attr.text)
             else:
                 break
-            expr.place(*start)
+            expr.place(start.line, start.pos)
         return stream, expr
 
-    @parsing_method
     def parse_primary(self, stream: Stream):
-        if stream.curr.type == "ident":
-            if stream.curr.text in self.macros["expr"]:
-                macro = self.macros["expr"][stream.curr.text]
-                stream, macro_stream = macro.apply(self, stream)
-                return stream, self.parse_expr(macro_stream)[1]
-            stream, var = stream.advance()
-            return stream, GetVar(var.text)
-        elif stream.curr.type == "$ident":
-            if stream.curr.text in stream.macro_symbols["expr"]:
-                stream, ident = stream.advance()
-                return stream, stream.macro_symbols["expr"][ident.text]
+        start = stream.curr
+        if start.kind == Kinds.IDENT:
+            trie = self.macros["expr"].get(start.text)
+            if trie is not None:
+                stream, macro, symbols = trie.apply(self, stream)
+                return stream, self.expand_macro(macro, symbols)
+            stream, _ = stream.advance()
+            expr = GetVar(start.text)
+        elif start.kind == Kinds.META_IDENT:
+            if start.text in stream.macro_symbols["expr"]:
+                stream, _ = stream.advance()
+                return stream, stream.macro_symbols["expr"][start.text]
             else:
-                raise stream.error(f"Expression meta-identifier {stream.curr.text} is not defined")
-        elif stream.curr.type in ("num", "hex", "str"):
-            type = stream.curr.type
-            stream, literal = stream.advance()
+                raise stream.error(f"Expression meta-identifier {start.text} is not defined")
+        elif start.kind in literal_kinds:
+            stream, _ = stream.advance()
             # noinspection PyTypeChecker
-            return stream, Literal(type, literal.text)
-        elif stream.curr.type == "(":
-            stream, _ = stream.expect("(")
-            stream, expr = self.parse_expr(stream)
-            stream, _ = stream.expect(")")
-            return stream, Grouping(expr)
-        elif stream.curr.type == "new":
-            stream, _ = stream.expect("new")
+            expr = Literal(start.type, start.text)
+        elif start.kind == Kinds.LPAREN:
+            stream, _ = stream.advance()
+            stream, inner = self.parse_expr(stream)
+            stream, _ = stream.expect(Kinds.RPAREN)
+            expr = Grouping(inner)
+        elif start.kind == Kinds.NEW:
+            stream, _ = stream.advance()
             stream, cls = self.parse_type(stream)
-            stream, args = self.arguments("(", stream, self.parse_expr, ")")
-            return stream, New(cls, args)
+            stream, args = self.arguments(Kinds.LPAREN, stream, self.parse_expr, Kinds.RPAREN)
+            expr = New(cls, args)
         else:
-            stream.error(f"Expected Expression, got {stream.curr.type}")
-
+            raise stream.error(f"Expected Expression, got {start.type}")
+        expr.place(start.line, start.pos)
+        return stream, expr
 
-def parse(tokens: List[Token]):
-    parser = Parser()
-    return parser.parse_program(Stream(tokens))
+    def parse_macro_definition(self, stream: Stream) -> (Stream, None):
+        return self.parse_macro(stream), None
+
+    top_level_rules: Dict[TokenKind, Callable] = {
+        Kinds.CLASS: parse_class,
+        Kinds.DEF: parse_function,
+        Kinds.MACRO: parse_macro_definition,
+        Kinds.IMPORT: parse_import,
+    }
+
+    class_body_rules: Dict[TokenKind, Callable] = {
+        Kinds.ATTR: parse_attr,
+        Kinds.METHOD: parse_method,
+        Kinds.NEW: parse_constructor,
+    }
+
+    base_stmt_rules: Dict[TokenKind, Callable] = {
+        Kinds.VAR: parse_var_stmt,
+        Kinds.RETURN: parse_return_stmt,
+        Kinds.IF: parse_if_stmt,
+        Kinds.WHILE: parse_while_stmt,
+        Kinds.LBRACE: parse_block,
+        Kinds.META_IDENT: parse_stmt_symbol,
+        Kinds.DEL: parse_delete,
+    }
+
+
+def parse(tokens: Iterable[Token], parser: Parser = None):
+    if parser is None:
+        parser = Parser()
+    if isinstance(tokens, (list, TokenTable)):
+        return parser.parse_program(Stream(tokens))
+    else:
+        return parser.parse_program(Stream(TokenBuffer(iter(tokens))))
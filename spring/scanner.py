@@ -1,9 +1,9 @@
 import re
 from dataclasses import dataclass, field
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from spring.spring_error import SpringError
-from spring.spring_token import Token
+from spring.spring_token import Kinds, Token, TokenKind, TokenTable, kind_types, kinds_by_type
 
 ORDER = "START"
 
@@ -42,124 +42,159 @@ keywords = [
 ]
 
 
-letters = "abcdefghijklmnopqrstuvwxyz"
-letters += letters.upper()
-letters += "_"
-
-digits = "0123456789"
-
-
 v = 3
 
 
-class ExtendedString(str):
-    def __getitem__(self, item):
-        try:
-            return super().__getitem__(item)
-        except IndexError:
-            return "\0"
+def _token_pattern(operators: List[str], meta_idents: bool):
+    """
+    Build the master pattern for one scanning mode. Alternatives are tried in order, which mirrors the order the
+    scanner used to try them in: operators (longest first), then literals, names, whitespace and directives.
+    """
+    alternatives = [
+        "(?P<op>" + "|".join(re.escape(op) for op in operators) + ")",
+        r"(?P<hex>0x[A-Fa-f0-9]+)",
+        r"(?P<num>[0-9]+(?:\.[0-9]+)?)",
+        r'(?P<str>"(?:\\.|[^"\\])*")',
+        r"(?P<name>[_a-zA-Z][_a-zA-Z0-9]*)",
+        r"(?P<space> +)",
+        r"(?P<newline>\n)",
+        r"(?P<comment>#(?!\S)[^\n]*\n?)",    # '# ' is a comment
+        r"(?P<directive>#(?P<hashcode>\S+))",  # '#' used for special directives
+    ]
+    if meta_idents:
+        alternatives.append(r"(?P<meta>\$[_a-zA-Z][_a-zA-Z0-9]*)")
+    return re.compile("|".join(alternatives))
+
+
+# Indexed by macro mode
+token_patterns = (
+    _token_pattern(basic_tokens, meta_idents=False),
+    _token_pattern(macro_basic_tokens + basic_tokens, meta_idents=True),
+)
+
+keyword_kinds: Dict[str, TokenKind] = {keyword: kinds_by_type[keyword] for keyword in keywords}
 
 
 @dataclass()
 class State:
+    """Where the scanner is at the start of a line, enough to resume scanning from there"""
     pos: int = field(default=0)
     line: int = field(default=1)
-    line_pos: int = field(default=0)
-
-
-def scan(text: str) -> List[Token]:
-    tokens = []
-    state = State()
+    macro_mode: bool = field(default=False)
+
+
+def _scan(text: str, state: State = None) -> Iterator[Tuple[Optional[TokenKind], Union[str, bool], int, int, int]]:
+    """
+    Yields (kind, text, line, start, end) for every token, where start and end are offsets into `text`, and
+    (None, macro_mode, line, line_start, line_start) whenever a new line starts.
+    """
+    if state is None:
+        state = State()
+    pos = state.pos
+    line = state.line
+    line_start = pos
+    end = len(text)
+
+    macro_mode = state.macro_mode
+    match_token = token_patterns[macro_mode].match
+
+    while pos < end:
+        match = match_token(text, pos)
+        if match is None:
+            line_pos = pos - line_start
+            raise ScanningError(f"Cannot scan tokens from {text[pos]}", line, (line_pos, line_pos + 1))
+
+        group = match.lastgroup
+        new_pos = match.end()
+
+        if group == "op":
+            kind = kinds_by_type[match.group()]
+            yield kind, kind_types[kind], line, pos, new_pos
+        elif group == "name":
+            name = match.group()
+            yield keyword_kinds.get(name, Kinds.IDENT), name, line, pos, new_pos
+        elif group == "newline":
+            line += 1
+            line_start = new_pos
+            yield None, macro_mode, line, line_start, line_start
+        elif group == "space":
+            pass
+        elif group == "num":
+            yield Kinds.NUM, match.group(), line, pos, new_pos
+        elif group == "str":
+            yield Kinds.STR, match.group(), line, pos, new_pos
+        elif group == "hex":
+            yield Kinds.HEX, match.group(), line, pos, new_pos
+        elif group == "meta":
+            yield Kinds.META_IDENT, match.group(), line, pos, new_pos
+        elif group == "comment":
+            if text[new_pos - 1] == "\n":
+                line += 1
+                line_start = new_pos
+                yield None, macro_mode, line, line_start, line_start
+        else:  # directive
+            hashcode = match.group("hashcode")
+            if hashcode == "macro" or hashcode == "endmacro":
+                macro_mode = hashcode == "macro"
+                match_token = token_patterns[macro_mode].match
+                kind = kinds_by_type[hashcode]
+                yield kind, kind_types[kind], line, pos + 1, new_pos
+            # elif hashcode == "import":
+            #     yield Kinds.IMPORT, "import", line, pos + 1, new_pos
+            else:
+                line_pos = pos + 1 - line_start
+                raise ScanningError(f"Unknown hashcode: {hashcode}", line, (line_pos, line_pos + len(hashcode)))
 
-    macro_mode = False
+        pos = new_pos
 
-    text = ExtendedString(text)
 
-    def advance(num):
-        state.pos += num
-        state.line_pos += num
+def iter_tokens(text: str) -> Iterator[Token]:
+    line_start = 0
+    for kind, token_text, line, start, end in _scan(text):
+        if kind is None:
+            line_start = start
+        else:
+            yield Token(kind, token_text, line, (start - line_start, end - line_start))
 
-    def advance_line():
-        state.pos += 1
-        state.line += 1
-        state.line_pos = 0
 
-    def expect(s):
-        if text[state.pos:state.pos + len(s)] == s:
-            advance(len(s))
+def scan(text: str) -> TokenTable:
+    table = TokenTable(text)
+    append = table.append
+    for kind, token_text, line, start, end in _scan(text):
+        if kind is None:
+            table.new_line(start, token_text)
         else:
-            raise ScanningError(f"Expected {s!r}, got {text[state.pos:state.pos + len(s)]!r}", state.line,
-                                (state.line_pos, state.line_pos + len(s)))
-
-    def add_if_match(s):
-        if text[state.pos:state.pos + len(s)] == s:
-            # print(s, True)
-            tokens.append(Token(s, s, state.line, (state.line_pos, state.line_pos + len(s))))
-            advance(len(s))
-            return True
+            append(kind, token_text, line, start, end)
+    return table
+
+
+def rescan(table: TokenTable, text: str, start: int, old_end: int, new_end: int) -> TokenTable:
+    """
+    Update `table` in place after the text it was scanned from had old[start:old_end] replaced with
+    text[start:new_end]. Scanning resumes from the checkpoint at the start of the line the edit begins in, and stops
+    at the first line after the edit where the scanner is in the same state it was in at the matching line of the old
+    text. The tokens from there on are kept and only moved.
+    """
+    delta = new_end - old_end
+
+    first_line = table.line_at(start)
+    state = State(table.line_start(first_line), first_line, table.line_mode(first_line))
+
+    first_token = table.line_token(first_line)
+    patch = table.patch()
+    patch.new_line(state.pos, state.macro_mode, first_token)
+    append = patch.append
+
+    for kind, token_text, line, token_start, token_end in _scan(text, state):
+        if kind is None:
+            if token_start >= new_end:
+                old_line = table.line_starting_at(token_start - delta)
+                if old_line is not None and table.line_mode(old_line) == token_text:
+                    table.splice(first_line, old_line, patch, text)
+                    return table
+            patch.new_line(token_start, token_text, first_token + len(patch))
         else:
-            # print(s, False)
-            return False
-
-    def add_regex(pattern, name):
-        match_ = re.match(pattern, text[state.pos:]).group()
-        tokens.append(Token(name, match_, state.line, (state.line_pos, state.line_pos + len(match_))))
-        advance(len(match_))
-
-    while state.pos < len(text):
-        if macro_mode and any(add_if_match(basic_token) for basic_token in macro_basic_tokens):
-            pass
-        elif any(add_if_match(basic_token) for basic_token in basic_tokens):
-            pass
-        else:   # Not a basic token
-            # start = line_pos
-            if text[state.pos:state.pos + 2] == "0x":
-                add_regex("0x[A-Fa-f0-9]+", "hex")
-            elif text[state.pos] in digits:
-                add_regex(r"[0-9]+(?:\.[0-9]+)?", "num")
-            elif text[state.pos] == "\"":
-                add_regex(r'"(?:\\.|[^"\\])*"', "str")
-            elif text[state.pos] in letters:
-                match = re.match("[_a-zA-Z][_a-zA-Z0-9]*", text[state.pos:]).group()
-                if match in keywords:
-                    tokens.append(Token(match, match, state.line, (state.line_pos, state.line_pos + len(match))))
-                else:
-                    tokens.append(Token("ident", match, state.line, (state.line_pos, state.line_pos + len(match))))
-                advance(len(match))
-            elif text[state.pos] == " ":
-                advance(1)
-            elif text[state.pos] == "\n":
-                advance_line()
-            elif text[state.pos] == "#":  # '#' used for special directives
-                hashcode = text[state.pos:].split(None, 1)[0][1:]
-                advance(1)
-                if hashcode == "":       # '# ' is a comment
-                    while text[state.pos] != "\n":
-                        advance(1)
-                    advance_line()
-                elif hashcode == "macro":
-                    macro_mode = True
-                    tokens.append(Token("macro", "macro", state.line, (state.line_pos, state.line_pos + len("macro"))))
-                    expect("macro")
-                elif hashcode == "endmacro":
-                    macro_mode = False
-                    tokens.append(
-                        Token("endmacro", "endmacro", state.line, (state.line_pos, state.line_pos + len("endmacro"))))
-                    expect("endmacro")
-                # elif hashcode == "import":
-                #     tokens.append(
-                #         Token("import", "import", state.line, (state.line_pos, state.line_pos + len("import"))))
-                #     advance(len("import"))
-                else:
-                    raise ScanningError(f"Unknown hashcode: {hashcode}", state.line,
-                                        (state.line_pos, state.line_pos + len(hashcode)))
-            elif macro_mode and text[state.pos] == "$" and text[state.pos + 1] in letters:
-                start = state.line_pos
-                match = re.match(r"\$[_a-zA-Z][_a-zA-Z0-9]*", text[state.pos:]).group()
-                advance(len(match))
-                tokens.append(Token("$ident", match, state.line, (start, state.line_pos)))
-            else:
-                raise ScanningError(f"Cannot scan tokens from {text[state.pos]}", state.line,
-                                    (state.line_pos, state.line_pos + 1))
+            append(kind, token_text, line, token_start, token_end)
 
-    return tokens
+    table.splice(first_line, None, patch, text)
+    return table
@@ -1,5 +1,5 @@
-from dataclasses import dataclass, field
-from typing import Dict, Any, List
+from dataclasses import dataclass, field, fields
+from typing import Dict, Any, List, Optional, Tuple
 
 __all__ = ['Node',
 
@@ -17,176 +17,177 @@ __all__ = ['Node',
            'Program', ]
 
 
-@dataclass()
+# Nodes are slotted, there are a lot of them. `meta` is only created when something first uses it.
+@dataclass(slots=True)
 class Node:
-    line: int = field(init=False)
-    pos: (int, int) = field(init=False)
-    meta: Dict[str, Any] = field(init=False)
+    line: int = field(init=False, default=None)
+    pos: (int, int) = field(init=False, default=None)
+    _meta: Optional[Dict[str, Any]] = field(init=False, default=None, repr=False, compare=False)
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        if self._meta is None:
+            self._meta = {}
+        return self._meta
 
     def place(self, line, line_pos):
-        self.meta = {}
-        has_line = hasattr(self, 'line')
-        has_pos = hasattr(self, 'pos')
-        if not (has_line or has_pos):
+        # A node keeps the first place it is given
+        if self.line is None:
             self.line = line
             self.pos = line_pos
-        elif has_line and has_pos:
-            pass
-        else:
-            raise Exception(f"Only one of .line or .pos defined")
 
 
-@dataclass()
+@dataclass(slots=True)
 class Type(Node):
     pass
 
 
-@dataclass()
+@dataclass(slots=True)
 class Name(Type):
     name: str
 
 
-@dataclass()
+@dataclass(slots=True)
 class GetName(Type):
     type: Type
     name: str
 
 
-@dataclass()
+@dataclass(slots=True)
 class Generic(Type):
     type: Type
     args: List[Type]
 
 
-@dataclass()
+@dataclass(slots=True)
 class Expr(Node):
     # ret_type: Type = field(init=False, default=None)
     pass
 
 
-@dataclass()
+@dataclass(slots=True)
 class BinOp(Expr):
     left: Expr
     op: str
     right: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class Unary(Expr):
     op: str
     right: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class Call(Expr):
     callee: Expr
     args: List[Expr]
 
 
-@dataclass()
+@dataclass(slots=True)
 class Cast(Expr):
     obj: Expr
     type: Type
 
 
-@dataclass()
+@dataclass(slots=True)
 class New(Expr):
     cls: Type
     args: List[Expr]
 
 
-@dataclass()
+@dataclass(slots=True)
 class Grouping(Expr):
     expr: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class GetVar(Expr):
     var: str
 
 
-@dataclass()
+@dataclass(slots=True)
 class GetAttr(Expr):
     obj: Expr
     attr: str
 
 
-@dataclass()
+@dataclass(slots=True)
 class Literal(Expr):
     type: str
     val: str
 
 
-@dataclass()
+@dataclass(slots=True)
 class SetVar(Expr):
     var: str
     val: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class SetAttr(Expr):
     obj: Expr
     attr: str
     val: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class Stmt(Node):
     pass
 
 
-@dataclass()
+@dataclass(slots=True)
 class Block(Stmt):
     stmts: List[Stmt]
 
 
-@dataclass()
+@dataclass(slots=True)
 class IfStmt(Stmt):
     cond: Expr
     then_do: Stmt
     else_do: Stmt
 
 
-@dataclass()
+@dataclass(slots=True)
 class WhileStmt(Stmt):
     cond: Expr
     body: Stmt
 
 
-@dataclass()
+@dataclass(slots=True)
 class VarStmt(Stmt):
     name: str
     typ: Type
     val: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class DeleteStmt(Stmt):
     obj: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class ReturnStmt(Stmt):
     expr: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class ExprStmt(Stmt):
     expr: Expr
 
 
-@dataclass()
+@dataclass(slots=True)
 class ClassStmt(Node):
     pass
 
 
-@dataclass()
+@dataclass(slots=True)
 class Attr(ClassStmt):
     name: str
     type: Type
 
 
-@dataclass()
+@dataclass(slots=True)
 class Method(ClassStmt):
     name: str
     args: Dict[str, Type]
@@ -194,32 +195,32 @@ class Method(ClassStmt):
     body: List[Stmt]
 
 
-@dataclass()
+@dataclass(slots=True)
 class Constructor(ClassStmt):
     args: Dict[str, Type]
     body: List[Stmt]
 
 
-@dataclass()
+@dataclass(slots=True)
 class TopLevel(Node):
     pass
 
 
-@dataclass()
+@dataclass(slots=True)
 class Class(TopLevel):
     name: str
     bases: List[Type]
     body: List[ClassStmt]
 
 
-@dataclass()
+@dataclass(slots=True)
 class GenericClass(Class):
     type_vars: List[str]
 
     implements: List[Class] = field(default_factory=list)
 
 
-@dataclass()
+@dataclass(slots=True)
 class Function(TopLevel):
     name: str
     params: Dict[str, Type]
@@ -227,24 +228,47 @@ class Function(TopLevel):
     body: List[Stmt]
 
 
-@dataclass()
+@dataclass(slots=True)
 class Overload(Node):
     args: Dict[str, Type]
     ret: Type
     body: List[Stmt]
 
 
-@dataclass()
+@dataclass(slots=True)
 class OverloadedFunction(TopLevel):
     name: str
     overloads: List[Overload]
 
 
-@dataclass()
+@dataclass(slots=True)
 class Import(TopLevel):
     file: str
 
 
-@dataclass()
+@dataclass(slots=True)
 class Program(Node):
     top_levels: List[TopLevel]
+
+
+# Looked up once per class, since walking a tree asks for them at every node
+_child_fields: Dict[type, Tuple[str, ...]] = {}
+
+
+def child_fields(cls: type) -> Tuple[str, ...]:
+    """The fields of node class `cls` that are passed to its constructor, which are the ones that can hold children"""
+    names = _child_fields.get(cls)
+    if names is None:
+        names = _child_fields[cls] = tuple(node_field.name for node_field in fields(cls) if node_field.init)
+    return names
+
+
+def count_nodes(node) -> int:
+    """The number of nodes in a tree, which may also hold lists and dicts of them"""
+    if isinstance(node, list):
+        return sum(count_nodes(item) for item in node)
+    if isinstance(node, dict):
+        return sum(count_nodes(item) for item in node.values())
+    if not isinstance(node, Node):
+        return 0
+    return 1 + sum(count_nodes(getattr(node, name)) for name in child_fields(type(node)))
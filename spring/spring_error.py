@@ -9,35 +9,37 @@ class SpringError(Exception):
         self.line = line
         self.line_pos = line_pos
 
-    def finish(self, path: str, full_text: str):
-        if self.DEBUG:
-            raise self
-        else:
-            if full_text and self.line > 0:
-                lines = full_text.split("\n")
+    def describe(self, path: str, full_text: str) -> str:
+        """The message, with the offending line of `full_text` and the place in it pointed out"""
+        if full_text and self.line > 0:
+            lines = full_text.split("\n")
 
-                offender = lines[self.line - 1]
+            offender = lines[self.line - 1]
 
-                arrow_size = self.line_pos[1] - self.line_pos[0]
-                left_over = (len(offender) - self.line_pos[1])
+            arrow_size = self.line_pos[1] - self.line_pos[0]
+            left_over = (len(offender) - self.line_pos[1])
 
-                arrows = " " * self.line_pos[0] + "^" * arrow_size + " " * left_over
+            arrows = " " * self.line_pos[0] + "^" * arrow_size + " " * left_over
 
-                cut_len = len(offender) - len(offender.lstrip())
-                arrows = arrows[cut_len:]
+            cut_len = len(offender) - len(offender.lstrip())
+            arrows = arrows[cut_len:]
 
-                offender = offender.lstrip()
+            offender = offender.lstrip()
 
-                err_start = "    " + str(self.line) + " | "
-                lines = [
-                    "File: " + path,
-                    err_start + offender,
-                    " " * len(err_start) + arrows,
-                    "Error: " + self.message
-                ]
-                msg = "\n".join(lines)
-            else:
-                msg = self.message
+            err_start = "    " + str(self.line) + " | "
+            lines = [
+                "File: " + path,
+                err_start + offender,
+                " " * len(err_start) + arrows,
+                "Error: " + self.message
+            ]
+            return "\n".join(lines)
+        else:
+            return self.message
 
-            sys.stderr.write(msg + "\n")
-            sys.exit()
+    def finish(self, path: str, full_text: str):
+        if self.DEBUG:
+            raise self
+        else:
+            sys.stderr.write(self.describe(path, full_text) + "\n")
+            sys.exit(1)
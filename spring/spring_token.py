@@ -1,15 +1,327 @@
-from typing import Tuple
+import bisect
+import operator
+from array import array
+from enum import IntEnum
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class TokenKind(IntEnum):
+    EOF = 0
+
+    IDENT = 1
+    META_IDENT = 2
+    NUM = 3
+    HEX = 4
+    STR = 5
+
+    MACRO = 6
+    ENDMACRO = 7
+
+    VAR = 8
+    DEL = 9
+    DEF = 10
+    CLASS = 11
+    METHOD = 12
+    ATTR = 13
+    IF = 14
+    ELSE = 15
+    WHILE = 16
+    RETURN = 17
+    IMPORT = 18
+    AND = 19
+    OR = 20
+    AS = 21
+    NEW = 22
+
+    ASSIGN = 23
+    PLUS_ASSIGN = 24
+    MINUS_ASSIGN = 25
+    STAR_ASSIGN = 26
+    POW_ASSIGN = 27
+    SLASH_ASSIGN = 28
+    FLOOR_DIV_ASSIGN = 29
+    MOD_ASSIGN = 30
+    PLUS = 31
+    MINUS = 32
+    STAR = 33
+    POW = 34
+    SLASH = 35
+    FLOOR_DIV = 36
+    MOD = 37
+    LT = 38
+    GT = 39
+    LE = 40
+    GE = 41
+    EQ = 42
+    NE = 43
+    NOT = 44
+    TILDE = 45
+    ARROW = 46
+    LPAREN = 47
+    RPAREN = 48
+    LBRACKET = 49
+    RBRACKET = 50
+    LBRACE = 51
+    RBRACE = 52
+    DOT = 53
+    COMMA = 54
+    SEMICOLON = 55
+    COLON = 56
+
+    MACRO_LPAREN = 57
+    MACRO_LBRACE = 58
+    MACRO_RPAREN = 59
+    MACRO_RBRACE = 60
+    FAT_ARROW = 61
+
+    @property
+    def type(self) -> str:
+        """The token type string the scanner and error messages use for this kind, e.g. 'ident' or '+'"""
+        return kind_types[self]
+
+
+kind_types: List[str] = [
+    "\0",
+    "ident", "$ident", "num", "hex", "str",
+    "macro", "endmacro",
+    "var", "del", "def", "class", "method", "attr", "if", "else", "while", "return", "import",
+    "and", "or", "as", "new",
+    "=", "+=", "-=", "*=", "**=", "/=", "//=", "%=",
+    "+", "-", "*", "**", "/", "//", "%",
+    "<", ">", "<=", ">=", "==", "!=",
+    "!", "~", "->",
+    "(", ")", "[", "]", "{", "}", ".", ",", ";", ":",
+    "$(", "${", ")$", "}$", "=>",
+]
+assert len(kind_types) == len(TokenKind)
+
+kinds_by_type: Dict[str, TokenKind] = {typ: TokenKind(n) for n, typ in enumerate(kind_types)}
+
+# Indexed by kind id, cheaper than calling TokenKind(id)
+_kinds: List[TokenKind] = list(TokenKind)
+
+# The members of TokenKind as attributes of a plain class. Looking a member up on the Enum class itself costs several
+# times more, and the scanner and parser compare kinds for every token.
+Kinds = type("Kinds", (), dict(TokenKind.__members__))
 
 
 class Token:
-    def __init__(self, typ: str, text: str, line: int, pos: Tuple[int, int]):
-        self.type = typ
+    __slots__ = ("kind", "text", "line", "pos")
+
+    def __init__(self, kind: TokenKind, text: str, line: int, pos: Tuple[int, int]):
+        self.kind = kind
         self.text = text
         self.line = line
         self.pos = pos
 
+    @property
+    def type(self) -> str:
+        return kind_types[self.kind]
+
     def __eq__(self, other: 'Token'):
-        return self.type == other.type and self.text == other.text
+        return self.kind == other.kind and self.text == other.text
 
     def __repr__(self):
         return f"Token({self.type!r}, {self.text!r})"
+
+
+class Shifts:
+    """
+    Deltas still to be added to rows of a table: `deltas[k]` to every row from `starts[k]` up to the next start.
+    Edits record how they moved the rows after them here, rather than rewriting all of those rows.
+    """
+    __slots__ = ("starts", "deltas", "moved")
+
+    def __init__(self, width: int):
+        self.starts: List[int] = [0]
+        self.deltas: List[Tuple[int, ...]] = [(0,) * width]
+        # Whether any delta was ever recorded, so that tables never edited needn't look
+        self.moved = False
+
+    def at(self, index: int) -> Tuple[int, ...]:
+        return self.deltas[bisect.bisect_right(self.starts, index) - 1]
+
+    def segment(self, k: int, rows: int) -> Tuple[int, int]:
+        """The rows the `k`th delta applies to, out of `rows`"""
+        return self.starts[k], self.starts[k + 1] if k + 1 < len(self.starts) else rows
+
+    def replace(self, first: int, stop: int, new_stop: int, delta: Tuple[int, ...]):
+        """Rows first up to stop were replaced with rows first up to new_stop, and the rows after moved by `delta`"""
+        kept = bisect.bisect_right(self.starts, first)
+        following = bisect.bisect_right(self.starts, stop)
+        starts = self.starts[:kept]
+        deltas = self.deltas[:kept]
+        if starts[-1] == new_stop:
+            starts.pop()
+            deltas.pop()
+
+        tail = tuple(map(operator.add, self.deltas[following - 1], delta))
+        if not deltas or deltas[-1] != tail:
+            starts.append(new_stop)
+            deltas.append(tail)
+        for start, old_delta in zip(self.starts[following:], self.deltas[following:]):
+            starts.append(start + new_stop - stop)
+            deltas.append(tuple(map(operator.add, old_delta, delta)))
+        self.starts = starts
+        self.deltas = deltas
+        self.moved = True
+
+
+class TokenTable:
+    """
+    Scanned tokens stored column-wise: one compact array each for the kind, the start and end offsets into the source,
+    and the line. Token texts are interned in `strings` and referred to by index, so each distinct identifier is
+    stored once. Indexing the table gives a `Token` view of a single row.
+
+    `text` is the source the table was scanned from. For every line the table also records where it starts, whether
+    the scanner was in macro mode there, and the index of its first token. These are the checkpoints
+    `spring.scanner.rescan` resumes scanning from.
+
+    After `splice`, the offsets, lines and token indexes stored for what followed the edit are out of date by however
+    much the edit moved them. `shifts` and `line_shifts` keep track of that, and the accessors add it, so an edit
+    costs as much as the lines it changes, however much of the table follows them.
+    """
+
+    def __init__(self, text: str = "", first_line: bool = True):
+        self.text = text
+
+        self.kinds = array('B')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.lines = array('i')
+        self.text_ids = array('i')
+        # Offset and line deltas for the tokens
+        self.shifts = Shifts(2)
+
+        self.line_starts = array('l')
+        self.line_modes = array('B')
+        self.line_tokens = array('l')
+        # Offset and token index deltas for the lines
+        self.line_shifts = Shifts(2)
+        if first_line:
+            self.new_line(0, False)
+
+        # The fixed text of each kind is interned under the kind's own id
+        self.strings: List[str] = list(kind_types)
+        self._string_ids: Dict[str, int] = {typ: n for n, typ in enumerate(kind_types)}
+
+    def patch(self) -> 'TokenTable':
+        """An empty table without any lines that shares this table's strings, to be spliced back into it"""
+        patch = TokenTable(self.text, first_line=False)
+        patch.strings = self.strings
+        patch._string_ids = self._string_ids
+        return patch
+
+    def append(self, kind: TokenKind, text: str, line: int, start: int, end: int):
+        text_id = self._string_ids.get(text)
+        if text_id is None:
+            text_id = self._string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.lines.append(line)
+        self.text_ids.append(text_id)
+
+    def new_line(self, line_start: int, macro_mode: bool, first_token: int = None):
+        self.line_starts.append(line_start)
+        self.line_modes.append(macro_mode)
+        self.line_tokens.append(len(self.kinds) if first_token is None else first_token)
+
+    def start(self, index: int) -> int:
+        """The offset of token `index` into the text"""
+        return self.starts[index] + self.shifts.at(index)[0]
+
+    def end(self, index: int) -> int:
+        return self.ends[index] + self.shifts.at(index)[0]
+
+    def line(self, index: int) -> int:
+        return self.lines[index] + self.shifts.at(index)[1]
+
+    def line_start(self, line: int) -> int:
+        """The offset of line `line`, counting from 1, into the text"""
+        return self.line_starts[line - 1] + self.line_shifts.at(line - 1)[0]
+
+    def line_mode(self, line: int) -> bool:
+        """Whether the scanner was in macro mode at the start of line `line`"""
+        return bool(self.line_modes[line - 1])
+
+    def line_token(self, line: int) -> int:
+        """The index of the first token on or after line `line`"""
+        return self.line_tokens[line - 1] + self.line_shifts.at(line - 1)[1]
+
+    def line_at(self, offset: int) -> int:
+        """The line `offset` is on, counting from 1"""
+        shifts = self.line_shifts
+        # Line starts are in order, so the first line of each shifted run is too
+        k = len(shifts.starts) - 1
+        while k > 0:
+            first = shifts.starts[k]
+            if first < len(self.line_starts) and self.line_starts[first] + shifts.deltas[k][0] <= offset:
+                break
+            k -= 1
+        low, high = shifts.segment(k, len(self.line_starts))
+        return bisect.bisect_right(self.line_starts, offset - shifts.deltas[k][0], low, high)
+
+    def line_starting_at(self, offset: int) -> Optional[int]:
+        """The line that starts at `offset`, if one does"""
+        line = self.line_at(offset)
+        return line if line > 0 and self.line_start(line) == offset else None
+
+    def splice(self, first_line: int, stop_line: Optional[int], patch: 'TokenTable', text: str):
+        """
+        Replace lines first_line up to (not including) stop_line, and their tokens, with the lines and tokens in
+        `patch`, which must come from `self.patch()`, now that the text is `text`. Lines from stop_line on are kept,
+        and are only moved. A stop_line of None replaces everything to the end.
+        """
+        first_token = self.line_token(first_line)
+        if stop_line is None:
+            stop_token = len(self)
+            stop_line = len(self.line_starts) + 1
+        else:
+            stop_token = self.line_token(stop_line)
+        offset_delta = len(text) - len(self.text)
+        line_delta = first_line + len(patch.line_starts) - stop_line
+        token_delta = first_token + len(patch) - stop_token
+
+        def stored(column: array, delta: int) -> array:
+            # The patch holds real values, but the shift of the rows before it applies to it too
+            return array(column.typecode, [value - delta for value in column]) if delta else column
+
+        offset_shift, line_shift = self.shifts.at(first_token)
+        self.kinds[first_token:stop_token] = patch.kinds
+        self.starts[first_token:stop_token] = stored(patch.starts, offset_shift)
+        self.ends[first_token:stop_token] = stored(patch.ends, offset_shift)
+        self.lines[first_token:stop_token] = stored(patch.lines, line_shift)
+        self.text_ids[first_token:stop_token] = patch.text_ids
+        self.shifts.replace(first_token, stop_token, first_token + len(patch), (offset_delta, line_delta))
+
+        offset_shift, token_shift = self.line_shifts.at(first_line - 1)
+        self.line_starts[first_line - 1:stop_line - 1] = stored(patch.line_starts, offset_shift)
+        self.line_modes[first_line - 1:stop_line - 1] = patch.line_modes
+        self.line_tokens[first_line - 1:stop_line - 1] = stored(patch.line_tokens, token_shift)
+        self.line_shifts.replace(first_line - 1, stop_line - 1, first_line - 1 + len(patch.line_starts),
+                                 (offset_delta, token_delta))
+        self.text = text
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index: int) -> Token:
+        if index < 0:
+            index += len(self.kinds)
+        kind = _kinds[self.kinds[index]]
+        line = self.lines[index]
+        start = self.starts[index]
+        end = self.ends[index]
+        if self.shifts.moved:
+            offset_shift, line_shift = self.shifts.at(index)
+            line += line_shift
+            start += offset_shift
+            end += offset_shift
+        line_start = self.line_start(line)
+        return Token(kind, self.strings[self.text_ids[index]], line, (start - line_start, end - line_start))
+
+    def __iter__(self) -> Iterator[Token]:
+        for index in range(len(self)):
+            yield self[index]
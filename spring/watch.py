@@ -0,0 +1,298 @@
+"""
+Keeps a program compiled while its sources are edited. A `Watcher` polls the modules of the program for changes and
+holds on to everything it made from them: each module's text and tokens, its parse, its lowered spkt module and its
+object file. When a module is saved, only it is scanned and parsed again, incrementally, and only it and the modules
+that import it, directly or not, are lowered and compiled again before everything is linked. Errors are reported and
+the watcher carries on, picking up where it left off once they are fixed.
+"""
+import itertools
+import operator
+import pathlib
+import subprocess
+import sys
+import time
+import traceback
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from spkt import spkt_nodes as spkt
+from spkt.ast_spkt import ModuleLoader
+from spkt.spkt_llvm import ObjectCache, Optimization, SpktToLLVM, compile_c_object, emit_object, file_stem, link
+from spring import instrument
+from spring.parser import Parser, parse
+from spring.scanner import rescan, scan
+from spring.spring_ast import Program
+from spring.spring_error import SpringError
+from spring.spring_token import TokenTable
+
+__all__ = ['Watcher']
+
+
+def common_prefix(a: str, b: str, limit: int) -> int:
+    # Slices are compared in C, so halving is far faster than comparing one character at a time in Python
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def common_suffix(a: str, b: str, limit: int) -> int:
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def edited_span(old: str, new: str) -> Tuple[int, int, int]:
+    """`start`, `old_end` and `new_end`, such that old[start:old_end] was replaced with new[start:new_end]"""
+    start = common_prefix(old, new, min(len(old), len(new)))
+    end = common_suffix(old, new, min(len(old), len(new)) - start)
+    return start, len(old) - end, len(new) - end
+
+
+class Source:
+    """A module as last read from disk: its tokens, and its program if it parsed"""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.stat: Optional[Tuple[int, int]] = None
+        self.text: Optional[str] = None
+        self.tokens: Optional[TokenTable] = None
+        self.parser = Parser(incremental=True)
+        self.program: Optional[Program] = None
+        self.imports: List[pathlib.Path] = []
+        self.missing = False
+
+    def refresh(self) -> bool:
+        """Read the module again if it changed on disk, returning whether its text did. Raises `SpringError`"""
+        stat = self.path.stat()
+        if (stat.st_mtime_ns, stat.st_size) == self.stat:
+            return False
+        self.stat = (stat.st_mtime_ns, stat.st_size)
+
+        text = self.path.read_text()
+        if text == self.text:
+            return False
+        self.text = text
+        self.program = None
+
+        # Scanning errors leave the tokens as they were, so the next edit is still found against them
+        if self.tokens is None:
+            self.tokens = scan(text)
+        else:
+            rescan(self.tokens, text, *edited_span(self.tokens.text, text))
+        with instrument.span("parse", path=str(self.path)):
+            self.program = parse(self.tokens, self.parser)
+        self.imports = [path.resolve() for path in ModuleLoader.imports(self.path, self.program)]
+        return True
+
+
+class Watcher:
+    """
+    Builds the program whose main module is `source` into `output` each time `update` finds one of its modules
+    changed. Object files are kept in `object_dir`, one for each module, and in `cache`, when given.
+    """
+
+    def __init__(self, source: pathlib.Path, output: pathlib.Path, object_dir: pathlib.Path,
+                 optimization: Optimization = None, cache: ObjectCache = None, out=sys.stderr):
+        self.main = source.resolve()
+        self.output = output
+        self.object_dir = object_dir
+        self.optimization = optimization if optimization is not None else Optimization()
+        self.cache = cache
+        self.out = out
+        self.target_machine = self.optimization.target_machine()
+
+        self.sources: Dict[pathlib.Path, Source] = {}
+        self.modules: Dict[pathlib.Path, spkt.Module] = {}
+        # Modules changed since they were last built, or that import one that did
+        self.stale: Set[pathlib.Path] = set()
+        self.c_objects: Dict[str, pathlib.Path] = {}
+        # The uses each module added to types declared elsewhere, which would otherwise pile up as it is lowered
+        # again and again
+        self.type_uses: Dict[pathlib.Path, List[Tuple[spkt.TypeDecl, list]]] = {}
+
+    def report(self, message: str):
+        self.out.write(message + "\n")
+        self.out.flush()
+
+    def refresh(self) -> Tuple[Optional[List[pathlib.Path]], Set[pathlib.Path]]:
+        """
+        Read every module of the program that changed, returning them all in dependency order along with the ones
+        whose text changed. The order is None if a module is missing, doesn't parse or is part of an import cycle.
+        """
+        order: List[pathlib.Path] = []
+        changed: Set[pathlib.Path] = set()
+        loading: List[pathlib.Path] = []
+        done: Set[pathlib.Path] = set()
+        cycles: List[str] = []
+        ok = True
+
+        def visit(path: pathlib.Path):
+            nonlocal ok
+            if path in done:
+                return
+            if path in loading:
+                cycle = loading[loading.index(path):] + [path]
+                cycles.append("Import cycle: " + " -> ".join(module_path.name for module_path in cycle))
+                ok = False
+                return
+
+            source = self.sources.get(path)
+            if source is None:
+                source = self.sources[path] = Source(path)
+            try:
+                if source.refresh():
+                    changed.add(path)
+            except OSError as e:
+                if not source.missing:
+                    self.report(f"Cannot read {path}: {e.strerror}")
+                source.missing = True
+                source.stat = None
+                ok = False
+                return
+            except SpringError as e:
+                self.report(e.describe(str(path), source.text))
+            source.missing = False
+            if source.program is None:
+                ok = False
+
+            loading.append(path)
+            for import_path in source.imports:
+                visit(import_path)
+            loading.pop()
+            done.add(path)
+            order.append(path)
+
+        visit(self.main)
+        if not ok:
+            # A cycle stays until one of its modules changes, and needn't be reported every time round
+            if changed:
+                for cycle in cycles:
+                    self.report(cycle)
+            return None, changed
+
+        # Forget the modules nothing imports any more
+        gone = set(self.sources) - done
+        for path in gone:
+            del self.sources[path]
+            self.modules.pop(path, None)
+            self.stale.discard(path)
+        self.release(gone)
+        return order, changed
+
+    def release(self, paths: Iterable[pathlib.Path]):
+        released: Dict[int, Tuple[spkt.TypeDecl, Set[int]]] = {}
+        for path in paths:
+            for typ, uses in self.type_uses.pop(path, ()):
+                released.setdefault(id(typ), (typ, set()))[1].update(map(id, uses))
+        for typ, ids in released.values():
+            # A type like int has a use for nearly every instruction, so this is kept out of Python's loop
+            kept = map(operator.not_, map(ids.__contains__, map(id, typ.typed_usages)))
+            typ.typed_usages[:] = itertools.compress(typ.typed_usages, kept)
+
+    def lower(self, order: List[pathlib.Path]):
+        """Lower the stale modules again, each after the ones it imports"""
+        self.release(self.stale)
+        loader = ModuleLoader()
+        loader.modules.update(self.modules)
+        for path in order:
+            if path not in self.stale:
+                continue
+
+            shared = [*spkt.Builtins.types.values(), *(func.type for func in spkt.Builtins.funcs.values())]
+            for import_path in self.sources[path].imports:
+                shared.extend(func.type for func in loader.modules[import_path].funcs.values())
+            lengths = [len(typ.typed_usages) for typ in shared]
+
+            loader.modules.pop(path, None)
+            try:
+                loader.load(path, self.sources[path].program)
+            finally:
+                # Even when lowering failed partway, so that what it did add is released when it is lowered again
+                self.type_uses[path] = [(typ, typ.typed_usages[length:]) for typ, length in zip(shared, lengths)
+                                        if len(typ.typed_usages) > length]
+        self.modules = loader.modules
+
+    def object_path(self, path: pathlib.Path) -> pathlib.Path:
+        return self.object_dir / f"{file_stem(path)}.o"
+
+    def compile(self, order: List[pathlib.Path]):
+        modules = [spkt.Builtins] + [self.modules[path] for path in order]
+        stale = [self.modules[path] for path in order if path in self.stale]
+        with instrument.span("codegen"):
+            ir_modules = SpktToLLVM().llvm_per_module(modules, only=stale)
+
+        self.object_dir.mkdir(parents=True, exist_ok=True)
+        objects = []
+        for mod, ir_module in zip(modules, ir_modules):
+            if isinstance(mod, spkt.CModule):
+                obj = self.c_objects.get(mod.name)
+                if obj is None:
+                    obj = self.object_dir / f"{mod.name}.o"
+                    compile_c_object(mod, obj, self.optimization.clang_flags(), self.cache)
+                    self.c_objects[mod.name] = obj
+            else:
+                obj = self.object_path(mod.path.resolve())
+                if mod.path.resolve() in self.stale:
+                    obj.write_bytes(emit_object(mod, ir_module, self.target_machine, self.optimization,
+                                                self.cache))
+            objects.append(obj)
+        link(objects, self.output)
+
+    def update(self) -> Optional[List[spkt.Module]]:
+        """
+        Build the program again if any of its modules changed since the last build that worked, returning its
+        modules, or None if nothing changed or something went wrong, which has been reported
+        """
+        order, changed = self.refresh()
+        if order is None:
+            # Once the errors are fixed, these still need building
+            self.stale.update(changed)
+            return None
+
+        # Modules come after everything they import, so one pass finds every module a change reaches
+        for path in order:
+            if path in changed or path not in self.modules or not self.object_path(path).exists() or any(
+                    import_path in self.stale for import_path in self.sources[path].imports):
+                self.stale.add(path)
+        if not self.stale:
+            return None
+
+        try:
+            self.lower(order)
+            self.compile(order)
+        except SpringError as e:
+            self.report(f"Error: {e.message}")
+            return None
+        except spkt.SprocketError as e:
+            self.report(f"Error: {e}")
+            return None
+        except subprocess.CalledProcessError as e:
+            # What went wrong was already written to stderr by the command itself
+            self.report(f"Error: {e.cmd[0]} failed with exit status {e.returncode}")
+            return None
+        except Exception:
+            # Anything else is a bug in the compiler, and the traceback is what finds it
+            self.report(traceback.format_exc().rstrip())
+            return None
+        self.stale.clear()
+        return [spkt.Builtins] + [self.modules[path] for path in order]
+
+    def watch(self, interval: float = 0.2, on_build=None):
+        """Poll for changes every `interval` seconds, building each time, until interrupted"""
+        while True:
+            start = time.perf_counter()
+            modules = self.update()
+            if modules is not None:
+                self.report(f"Built {self.output} in {(time.perf_counter() - start) * 1000:.0f} ms")
+                if on_build is not None:
+                    on_build(modules)
+            time.sleep(interval)
@@ -1,5 +1,5 @@
 from spkt import compile_spkt, ast_to_spkt
-from spring import parse_text
+from spring import default_cache, parse_text
 
 
 def main():
@@ -7,9 +7,10 @@ def main():
     with open(path, "r") as file:
         text = file.read()
 
-    program = parse_text(path, text)
+    cache = default_cache()
+    program = parse_text(path, text, cache)
 
-    compile_spkt(ast_to_spkt(program, path), and_run=True)
+    compile_spkt(ast_to_spkt(program, path, cache), and_run=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,21 @@
+from spring.ast_cache import FileCache
+
+
+def test_eviction(tmp_path, monkeypatch):
+    cache = FileCache(tmp_path / "cache", max_bytes=1000)
+    evictions = []
+    evict = FileCache.evict
+    monkeypatch.setattr(FileCache, "evict", lambda self: evictions.append(1) or evict(self))
+
+    for n in range(50):
+        cache.write(f"{n:02}", b"x" * 100)
+        assert sum(path.stat().st_size for path in cache.directory.iterdir()) <= 1000
+    # The files are listed on the first write and when they go over, not on every write
+    assert len(evictions) < 50
+    assert sorted(path.name for path in cache.directory.iterdir()) == [f"{n:02}" for n in range(40, 50)]
+
+    # Writing a key again replaces its file, which doesn't grow the cache
+    evictions.clear()
+    for _ in range(5):
+        cache.write("49", b"x" * 100)
+    assert not evictions
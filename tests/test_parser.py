@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from benchmarks.generator import program
+from spring import parse_text
+from spring.parser import LookbackError, Parser, TokenBuffer, parse
+from spring.scanner import iter_tokens, rescan, scan
+from spring.spring_error import SpringError
+
+INSERTED_LINES = ["", "# c", "def added() -> int { return 1; }",
+                  "#macro $(show $x : expr)$ => stmt : $( print($x); )$ #endmacro"]
+
+
+def edit(rand: random.Random, text: str) -> (int, int, str):
+    """Somewhere to replace, and what with: lines inserted, top levels deleted, the end cut off or a number changed"""
+    line_starts = [0] + [n + 1 for n, char in enumerate(text) if char == "\n"]
+    top_levels = [start for start in line_starts if text.startswith(("def ", "class ", "#macro"), start)]
+    choice = rand.randrange(4)
+    if choice == 0:
+        start = rand.choice(line_starts)
+        return start, start, "\n".join(rand.sample(INSERTED_LINES, rand.randint(1, 2))) + "\n"
+    if choice == 1:
+        first = rand.randrange(len(top_levels) - 1)
+        stop = min(len(top_levels) - 1, first + rand.choice([1, 1, 3]))
+        return top_levels[first], top_levels[stop], ""
+    if choice == 2:
+        return rand.choice(top_levels[len(top_levels) // 2:]), len(text), ""
+    numbers = [n for n, char in enumerate(text) if char.isdigit()]
+    start = rand.choice(numbers)
+    return start, start + 1, rand.choice(["7", "70", "7\n"])
+
+
+def test_incremental_parse_matches_parse():
+    rand = random.Random(3)
+    text = program(functions=30, classes=3, overloads=3, seed=2)
+    table = scan(text)
+    parser = Parser(incremental=True)
+    parse(table, parser)
+    reparsed = 0
+    for _ in range(150):
+        if len(text) < 2000:
+            # Cut down too far to be worth editing, so start again
+            text = program(functions=30, classes=3, overloads=3, seed=rand.randrange(100))
+            table = scan(text)
+            parse(table, parser)
+        start, old_end, inserted = edit(rand, text)
+        old_text, text = text, text[:start] + inserted + text[old_end:]
+        table = rescan(table, text, start, old_end, start + len(inserted))
+        try:
+            expected = parse(scan(text))
+        except SpringError:
+            with pytest.raises(SpringError):
+                parse(table, parser)
+            # Undone, which the parser has to pick up from after the error
+            text, table = old_text, rescan(table, old_text, start, start + len(inserted), old_end)
+            continue
+        assert repr(parse(table, parser)) == repr(expected)
+        reparsed += 1
+    assert reparsed > 100
+
+
+def test_macros_moved():
+    text = program(functions=5, classes=1, overloads=1, seed=4)
+    table = scan(text)
+    parser = Parser(incremental=True)
+    parse(table, parser)
+    # Every macro moves down, and so must the nodes the functions copied from their bodies
+    text = "\n\n" + text
+    table = rescan(table, text, 0, 0, 2)
+    assert repr(parse(table, parser)) == repr(parse(scan(text)))
+
+
+def test_macro_forms_sharing_a_prefix():
+    text = """\
+#macro $(log $x : expr)$ => stmt : $( print($x); )$ #endmacro
+#macro $(log $x : expr $y : expr)$ => stmt : $( print($x + $y); )$ #endmacro
+def main() -> int {
+    log 1 2
+    log 3
+    return 0;
+}
+"""
+    for parsed in parse(scan(text)), parse_text("main.spng", text):
+        one, two, ret = parsed.top_levels[0].body
+        assert one.expr.args[0].op == "+"
+        assert two.expr.args[0].val == "3"
+        assert ret.expr.val == "0"
+
+
+def test_macro_fallback_further_back_than_the_token_window():
+    # `m`'s second argument only fails at the `;` after a hundred arguments, and `m 1` is parsed again from before it
+    args = ", ".join(["a"] * 100)
+    text = f"""\
+#macro $(m $x : expr)$ => stmt : $( f($x); )$ #endmacro
+#macro $(m $x : expr $y : expr)$ => stmt : $( f($x, $y); )$ #endmacro
+#macro $(q ( $a : expr ) !)$ => expr : $( $a )$ #endmacro
+#macro $(q ( $a : expr ) ;)$ => stmt : $( f($a); )$ #endmacro
+def f() -> int {{ m 1 q (g({args})) ; return 0; }}
+"""
+    expected = repr(parse(scan(text)))
+    assert len(parse(scan(text)).top_levels[0].body) == 3
+    assert repr(parse_text("main.spng", text)) == expected
+    assert repr(parse(iter_tokens(text))) == expected
+
+
+def test_token_buffer_lookback():
+    tokens = TokenBuffer(iter_tokens("def f() -> int { return 1 + 2 + 3 + 4; }"), window=2)
+    assert tokens[10].text == "2"
+    # The window's worth of tokens before the furthest one read are still there
+    assert tokens[9].text == "+"
+    with pytest.raises(LookbackError):
+        tokens[0]
@@ -0,0 +1,53 @@
+import random
+
+from benchmarks.generator import program
+from spring.scanner import ScanningError, rescan, scan
+from spring.spring_token import TokenTable
+
+SNIPPETS = ["x", "\n", " ", "+", "#macro ", "#endmacro\n", "\"", "# c\n", "def f() { return 1; }\n", "$x", "", "12.5",
+            "\n\n"]
+
+
+def rows(table: TokenTable):
+    tokens = [(token.kind, token.text, token.line, token.pos, table.start(index), table.end(index))
+              for index, token in enumerate(table)]
+    lines = [(table.line_start(line), table.line_mode(line), table.line_token(line))
+             for line in range(1, len(table.line_starts) + 1)]
+    return tokens, lines
+
+
+def test_rescan_matches_scan():
+    rand = random.Random(5)
+    text = program(functions=12, classes=2, overloads=2, seed=1)
+    table = scan(text)
+    rescanned = 0
+    for _ in range(800):
+        start = rand.randrange(len(text) + 1)
+        old_end = min(len(text), start + rand.choice([0, 0, 1, 2, 5, 30, 400]))
+        inserted = rand.choice(SNIPPETS)
+        new_text = text[:start] + inserted + text[old_end:]
+        try:
+            expected = scan(new_text)
+        except ScanningError:
+            continue
+
+        rescan(table, new_text, start, old_end, start + len(inserted))
+        assert table.text == new_text
+        assert rows(table) == rows(expected)
+        text = new_text
+        rescanned += 1
+    assert rescanned > 500
+
+
+def test_line_lookup():
+    text = program(functions=20, classes=2, overloads=2, seed=2)
+    table = scan(text)
+    for start, inserted in [(len(text) // 2, "\n\n"), (10, "x"), (len(text) - 5, "\n")]:
+        text = text[:start] + inserted + text[start:]
+        rescan(table, text, start, start, start + len(inserted))
+    for line in range(1, len(table.line_starts) + 1):
+        offset = table.line_start(line)
+        assert table.line_at(offset) == line
+        assert table.line_starting_at(offset) == line
+        if offset + 1 < len(text) and text[offset] != "\n":
+            assert table.line_starting_at(offset + 1) is None
@@ -0,0 +1,29 @@
+import llvmlite.binding as llvm
+
+from spkt.ast_spkt import to_spkt
+from spkt.spkt_llvm import SpktToLLVM
+from spring.parser import parse
+from spring.scanner import scan
+
+HELPER = """\
+import "test.h"
+
+def helper() -> int {
+    test.test();
+    return 0;
+}
+"""
+
+
+def test_modules_with_the_same_function(tmp_path):
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "util.spng").write_text(HELPER)
+    main_text = 'import "lib/util.spng"\n' + HELPER + "\ndef main() -> int {\n    util.helper();\n    return 0;\n}\n"
+    main_path = tmp_path / "main.spng"
+    main_path.write_text(main_text)
+
+    modules = to_spkt(parse(scan(main_text)), main_path)
+    llvm_module = llvm.parse_assembly(str(SpktToLLVM().llvm_from_modules(modules)))
+    names = {func.name for func in llvm_module.functions if not func.is_declaration}
+    # Named relative to the main module, so they are the same wherever the program is
+    assert names == {"main", "lib/util.spng:helper", "main.spng:helper"}